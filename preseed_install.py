@@ -4,13 +4,39 @@
 import sys
 import os
 import os.path
-import shutil
 import subprocess
 import re
 import tempfile
 import shlex
+import stat
+import abc
 import argparse
-from typing import Tuple, NamedTuple, Iterable, IO, Optional
+import mmap
+import errno
+import struct
+import zlib
+import uuid
+import hashlib
+import json
+import asyncio
+import urllib.parse
+import platform
+import logging
+import fcntl
+import contextlib
+import functools
+import gzip
+import queue
+import threading
+import concurrent.futures
+import socket
+import time
+import shutil
+import weakref
+from typing import Tuple, NamedTuple, Iterable, Iterator, IO, Optional, Dict, List, Any
+from typing import Callable, Union
+
+logger = logging.getLogger(__name__)
 
 
 class Partition(NamedTuple):
@@ -21,55 +47,177 @@ class Partition(NamedTuple):
     bootable: bool
 
 
+class IsoFile(NamedTuple):
+    path: str
+    offset: int
+    size: int
+    is_dir: bool
+
+
+class BootFiles(NamedTuple):
+    kernel: str
+    initrd: str
+    media: str
+
+
+class CopyStats(NamedTuple):
+    copied: int
+    skipped: int
+
+
+class CacheConfig(NamedTuple):
+    directory: str
+    max_size: int
+
+
+class LibraryEntry(NamedTuple):
+    filename: str
+    version: int
+    architecture: str
+    kernel: str
+    initrd: str
+    media: str
+    sha256: str
+    size: int
+
+
+MBR_PARTITION_TYPES = {
+    0x05: "Extended",
+    0x07: "HPFS/NTFS/exFAT",
+    0x0b: "W95 FAT32",
+    0x0c: "W95 FAT32 (LBA)",
+    0x0e: "W95 FAT16 (LBA)",
+    0x0f: "W95 Ext'd (LBA)",
+    0x82: "Linux swap / Solaris",
+    0x83: "Linux",
+    0x85: "Linux extended",
+    0x8e: "Linux LVM",
+    0xee: "GPT",
+    0xef: "EFI (FAT-12/16/32)",
+    0xfd: "Linux raid autodetect",
+}
+
+MBR_EXTENDED_PARTITION_TYPES = (0x05, 0x0f, 0x85)
+
+GPT_PARTITION_TYPES = {
+    "C12A7328-F81F-11D2-BA4B-00A0C93EC93B": "EFI System",
+    "21686148-6449-6E6F-744E-656564454649": "BIOS boot",
+    "0FC63DAF-8483-4772-8E79-3D69D8477DE4": "Linux filesystem",
+    "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F": "Linux swap",
+    "E6D6D379-F507-44C2-A23C-238F2A3DF928": "Linux LVM",
+    "A19D880F-05FC-4D3B-A006-743F0F84911E": "Linux RAID",
+    "44479540-F297-41B2-9AF7-D131D5F0458A": "Linux root (x86)",
+    "4F68BCE3-E8CD-4DB1-96E7-FBCAF984B709": "Linux root (x86-64)",
+    "69DAD710-2CE4-4E3C-B16C-21A1D49ABED3": "Linux root (ARM)",
+    "B921B045-1DF0-41C3-AF44-4C6F280D3FAE": "Linux root (ARM-64)",
+}
+
+LINUX_PARTITION_TYPES = (
+    "Linux",
+    "Linux filesystem",
+    "Linux root (x86)",
+    "Linux root (x86-64)",
+    "Linux root (ARM)",
+    "Linux root (ARM-64)",
+)
+
+GUEST_NAME = "preseed_install"
+
+DIGEST_XATTR = "user.preseed_install.sha256"
+
+
 def install(
-        iso_filename: str,
-        preseed_url: str,
+        iso: "IsoInfo",
+        preseed_url: Optional[str],
         output_filename: str,
         vnc_display: Optional[str] = None,
+        cache: Optional[CacheConfig] = None,
+        preseed_filename: Optional[str] = None,
+        installer_hd_mode: str = "image",
+        x86_devices: str = "virtio",
+        cpus: Union[int, str] = "auto",
+        memory: Union[int, str] = "auto",
+        disk_io: str = "install",
+        accel: str = "auto",
+        apt_proxy: bool = False,
     ) -> None:
-    """Perform automated Debian installation from an ISO image into a QEMU disk image."""
+    """Perform automated Debian installation from an ISO image into a QEMU disk image.
+
+    Exactly one of a preseed URL and a local preseed file is required."""
+    if bool(preseed_url) == bool(preseed_filename):
+        raise ValueError("exactly one of preseed URL and preseed file is required")
+    if apt_proxy and not cache:
+        raise ValueError("the APT proxy requires a cache")
     arch_qemu_map = {
         "amd64": "qemu-system-x86_64",
         "i386": "qemu-system-i386",
         "arm64": "qemu-system-aarch64",
         "armhf": "qemu-system-arm",
     }
-    arch = get_debian_architecture(iso_filename)
+    iso_filename = iso.filename
+    arch = iso.architecture
     if arch not in arch_qemu_map:
         raise ValueError(f"unsupported architecture: {arch}")
-    iso_kernel, iso_initrd = iso_get_boot_filenames(iso_filename)
-    tmp_kernel = named_tmp(iso_extract_file(iso_filename, iso_kernel))
-    tmp_initrd = named_tmp(iso_extract_file(iso_filename, iso_initrd))
+    boot_files = iso_get_boot_filenames(iso, cache)
+    iso_kernel, iso_initrd = boot_files.kernel, boot_files.initrd
+    if cache:
+        kernel, initrd = iso_extract_files_cached(iso_filename, [iso_kernel, iso_initrd], cache)
+    else:
+        kernel, initrd = iso_extract_files_tmp(iso_filename, [iso_kernel, iso_initrd])
+    kernel_parameters = [("auto", "true"), ("priority", "critical")]
+    if preseed_filename and cache:
+        # the installer loads /preseed.cfg from the initrd automatically
+        initrd = initrd_add_preseed_cached(initrd, preseed_filename, cache)
+    elif preseed_filename:
+        initrd = initrd_add_preseed(initrd, preseed_filename)
+    else:
+        kernel_parameters.append(("url", str(preseed_url)))
+    cpus, memory = guest_resources(cpus, memory, arch, count_running_installs())
+    if accel == "auto":
+        accel = select_accelerator(arch)
+    logger.info("accelerator: %s, vCPUs: %d, memory: %d MiB", accel, cpus, memory // 1024 ** 2)
+    target_drive = f"file={output_filename}"
+    if disk_io == "install":
+        target_drive += "".join(f",{option}" for option in install_drive_options(output_filename))
     command = [
         arch_qemu_map[arch],
-        "-cpu", "max", "-m", "1G",
-        "-append", " ".join(f"{name}={value}" for name, value in [
-            ("auto", "true"),
-            ("priority", "critical"),
-            ("url", preseed_url),
-        ]),
-        "-kernel", tmp_kernel.name,
-        "-initrd", tmp_initrd.name,
+        "-name", GUEST_NAME,
+        "-accel", accel,
+        "-cpu", "max", "-smp", str(cpus), "-m", f"{memory // (1024 * 1024)}M",
+        "-kernel", kernel.name,
+        "-initrd", initrd.name,
         "-display", f"vnc={vnc_display}" if vnc_display else "none",
         "-no-reboot",
     ]
-    if iso_is_arm(iso_filename):
+    if iso_is_arm(iso):
         virtio_type = "pci" if arch == "arm64" else "device"
         command += [
-            "-M", "virt",
-            "-drive", f"if=none,file={output_filename},format=qcow2,id=hd",
+            # let KVM use the host's interrupt controller version
+            "-M", "virt,gic-version=max" if accel.startswith("kvm") else "virt",
+            "-drive", f"if=none,{target_drive},format=qcow2,id=hd",
             "-device", f"virtio-blk-{virtio_type},drive=hd",
             "-netdev", "user,id=mynet",
             "-device", f"virtio-net-{virtio_type},netdev=mynet",
         ]
-        if arch == "armhf" and get_debian_version(iso_filename) == 9:
+        if boot_files.media == "hd-media":
             # Can't install from a CD-ROM. Therefore, put the ISO in a hard
             # disk image and use the hd-media installer. Set the disk up using
             # the SCSI driver instead of virtio in order to make it easy to
             # tell the source and destination disks apart.
-            installer_hd = create_installer_hd(iso_filename)
+            installer_hd: Union[IO, "tempfile.TemporaryDirectory[str]"]
+            if installer_hd_mode == "vvfat":
+                installer_hd = create_installer_hd_directory(iso_filename)
+                # commas in option values are escaped by doubling them
+                escaped_directory = installer_hd.name.replace(",", ",,")
+                installer_hd_drive = f"file=fat:32:{escaped_directory},format=raw,readonly=on"
+            elif cache:
+                installer_hd = create_installer_hd_overlay(iso_filename, cache)
+                installer_hd_drive = f"file={installer_hd.name},format=qcow2"
+            else:
+                installer_hd = create_installer_hd(iso_filename)
+                installer_hd_drive = f"file={installer_hd.name},format=raw"
             command += [
-                "-drive", f"if=none,file={installer_hd.name},id=installer_hd,format=raw",
+                "-drive", f"if=none,{installer_hd_drive},id=installer_hd",
                 "-device", "virtio-scsi-device",
                 "-device", "scsi-hd,drive=installer_hd",
             ]
@@ -79,35 +227,287 @@ def install(
                 "-device", "virtio-scsi-device",
                 "-device", "scsi-cd,drive=cdrom",
             ]
-    else:
+    elif x86_devices == "legacy":
         command += [
-            "-accel", "kvm",
-            "-drive", f"file={output_filename}",
+            "-drive", target_drive,
             "-cdrom", iso_filename,
             "-net", "nic", "-net", "user",
         ]
-    subprocess.run(command, check=True)
+    else:
+        command += [
+            "-drive", f"if=none,{target_drive},format=qcow2,id=hd",
+            "-device", "virtio-blk-pci,drive=hd",
+            "-cdrom", iso_filename,
+            "-netdev", "user,id=mynet",
+            "-device", "virtio-net-pci,netdev=mynet",
+        ]
+    with contextlib.ExitStack() as stack:
+        # start the proxy last, so that a failing setup can't leave it running
+        if apt_proxy and cache:
+            proxy = stack.enter_context(
+                AptProxy(os.path.join(cache.directory, "apt"), cache.max_size)
+            )
+            # the host as seen from the user mode network
+            proxy_url = f"http://10.0.2.2:{proxy.port}/"
+            kernel_parameters.append(("mirror/http/proxy", proxy_url))
+            logger.warning(
+                "the installed system will keep the APT proxy %s in /etc/apt/apt.conf,"
+                " unless the preseed configuration removes it",
+                proxy_url,
+            )
+        command += ["-append", " ".join(f"{name}={value}" for name, value in kernel_parameters)]
+        subprocess.run(command, check=True)
+    if disk_io == "install":
+        flush_file(output_filename)
+
+
+def install_drive_options(image_filename: str) -> List[str]:
+    """Get QEMU drive options for fast writes to a throwaway installation disk.
+
+    Guest flushes are ignored, freed and zeroed blocks are unmapped, and
+    io_uring is used where QEMU supports it. Native AIO would need
+    O_DIRECT, which bypasses the host page cache that makes ignoring
+    flushes worthwhile. A disk left behind by an unfinished installation is
+    useless anyway, so crash safety only matters once QEMU exits, when
+    install() flushes the image."""
+    options = ["cache=unsafe", "discard=unmap", "detect-zeroes=unmap"]
+    if qemu_supports_io_uring(image_filename):
+        options.append("aio=io_uring")
+    return options
+
+
+def qemu_supports_io_uring(image_filename: str) -> bool:
+    """Check whether QEMU can access an image with io_uring.
+
+    QEMU can be built without io_uring support and the kernel can have it
+    disabled. Probed with qemu-img, which comes from the same build."""
+    escaped_filename = image_filename.replace(",", ",,")
+    image_opts = f"driver=file,filename={escaped_filename},aio=io_uring"
+    command = ["qemu-img", "info", "--image-opts", image_opts]
+    try:
+        process = subprocess.run(command, capture_output=True, check=False)
+    except FileNotFoundError:
+        return False
+    return process.returncode == 0
+
+
+def flush_file(filename: str) -> None:
+    """Flush a file's data from the host page cache to its storage."""
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def select_accelerator(arch: str) -> str:
+    """Select a QEMU accelerator for a guest architecture.
+
+    KVM needs a host of the same architecture and access to /dev/kvm.
+    Otherwise, TCG translates guest code on all vCPUs in parallel. The
+    translation block cache size is left at QEMU's default, because the
+    tb-size property needs QEMU 5.0."""
+    kvm_host_machines = {
+        "amd64": ("x86_64",),
+        "i386": ("x86_64", "i386", "i686"),
+        "arm64": ("aarch64",),
+        "armhf": ("armv7l",),
+    }
+    host_machine = platform.machine()
+    if host_machine in kvm_host_machines.get(arch, ()) and os.access("/dev/kvm", os.R_OK | os.W_OK):
+        return "kvm"
+    return "tcg,thread=multi"
+
+
+def guest_resources(
+        cpus: Union[int, str],
+        memory: Union[int, str],
+        arch: str,
+        running_installs: int,
+    ) -> Tuple[int, int]:
+    """Get the number of vCPUs and the memory size in bytes for an installation guest.
+
+    Values set to "auto" are an equal share of the host CPUs and of half the
+    available memory, split between this and the running installs. The
+    memory is kept between 1 GiB and 4 GiB, or 3 GiB for 32-bit guests, and
+    the vCPU count is capped at 8, beyond which installs don't get faster."""
+    shares = running_installs + 1
+    if cpus == "auto":
+        cpus = min(8, max(1, (os.cpu_count() or 1) // shares))
+    if memory == "auto":
+        max_memory = (3 if arch in ("i386", "armel", "armhf") else 4) * 1024 ** 3
+        available = available_memory()
+        if available is None:
+            memory = 1024 ** 3
+        else:
+            memory = min(max_memory, max(1024 ** 3, available // 2 // shares))
+    return int(cpus), int(memory)
+
+
+def available_memory() -> Optional[int]:
+    """Get the memory available for starting new applications in bytes, if known."""
+    try:
+        with open("/proc/meminfo", "r", encoding="ascii") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def count_running_installs() -> int:
+    """Count the installation guests running on the host, by their QEMU process names."""
+    count = 0
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as cmdline_file:
+                cmdline = cmdline_file.read().split(b"\0")
+        except OSError:
+            continue
+        if b"-name" in cmdline[:-1] and cmdline[cmdline.index(b"-name") + 1] == GUEST_NAME.encode():
+            count += 1
+    return count
+
+
+def iso_get_boot_filenames(iso: "IsoInfo", cache: Optional[CacheConfig] = None) -> BootFiles:
+    """Get the paths of the Debian installer kernel and initrd files for an ISO image.
 
+    The paths are discovered by scanning the image. With a cache configured,
+    the result is stored in an index keyed by the image digest, so that each
+    image is only scanned once."""
+    if not cache:
+        return discover_boot_files(iso_list_installer_files(iso.filename), iso.architecture)
+    index_filename = os.path.join(cache.directory, "boot-index.json")
+    iso_digest = cached_file_digest(iso.filename, cache)
+    with locked_json(index_filename) as index:
+        if iso_digest in index:
+            return BootFiles(**index[iso_digest])
+    boot_files = discover_boot_files(iso_list_installer_files(iso.filename), iso.architecture)
+    with locked_json(index_filename) as index:
+        index[iso_digest] = boot_files._asdict()
+    return boot_files
 
-def iso_get_boot_filenames(iso_filename: str) -> Tuple[str, str]:
-    """Get the paths of the Debian installer kernel and initrd files for an ISO image."""
-    va_path_map = {
-        (9, "i386"): ("/install.386/vmlinuz", "/install.386/initrd.gz"),
-        (9, "amd64"): ("/install.amd/vmlinuz", "/install.amd/initrd.gz"),
-        (9, "arm64"): ("/install.a64/vmlinuz", "/install.a64/initrd.gz"),
-        (9, "armhf"): ("/install/hd-media/vmlinuz", "/install/hd-media/initrd.gz"),
-        (10, "i386"): ("/install.386/vmlinuz", "/install.386/initrd.gz"),
-        (10, "amd64"): ("/install.amd/vmlinuz", "/install.amd/initrd.gz"),
-        (10, "arm64"): ("/install.a64/vmlinuz", "/install.a64/initrd.gz"),
-        (10, "armhf"): ("/install.ahf/cdrom/vmlinuz", "/install.ahf/cdrom/initrd.gz"),
-        (11, "amd64"): ("/install.amd/vmlinuz", "/install.amd/initrd.gz"),
-        (12, "amd64"): ("/install.amd/vmlinuz", "/install.amd/initrd.gz"),
+
+def iso_list_installer_files(iso_filename: str) -> List[str]:
+    """List the paths of all files in the installer directories of an ISO image."""
+    def is_installer_path(iso_file: IsoFile) -> bool:
+        return iso_file.path.startswith("/install")
+
+    with IsoImage(iso_filename) as iso:
+        return [
+            iso_file.path
+            for iso_file in iso.walk(is_installer_path)
+            if is_installer_path(iso_file) and not iso_file.is_dir
+        ]
+
+
+def discover_boot_files(paths: Iterable[str], architecture: str) -> BootFiles:
+    """Find the Debian installer kernel and initrd among the files of an ISO image.
+
+    Recognized layouts, in the order of preference, are: an installer for
+    booting from the CD-ROM directly in an install.* directory, a cdrom
+    installer flavour in a subdirectory and an hd-media installer flavour,
+    which expects the ISO image on a hard disk. On multi-architecture
+    images the architecture is recognized by the install.* directory
+    suffix."""
+    layouts = [
+        (r"/install\.[^/]+", "cdrom"),
+        (r"/install[^/]*/cdrom", "cdrom"),
+        (r"/install[^/]*/hd-media", "hd-media"),
+    ]
+    arch_suffix_map = {
+        "i386": "386",
+        "amd64": "amd",
+        "arm64": "a64",
+        "armhf": "ahf",
+        "armel": "arm",
     }
-    version = get_debian_version(iso_filename)
-    arch = get_debian_architecture(iso_filename)
-    if (version, arch) in va_path_map:
-        return va_path_map[(version, arch)]
-    raise ValueError(f"unsupported Debian version or architecture: {version}, {arch}")
+    arch_directory = "install." + arch_suffix_map.get(architecture, architecture)
+    paths = set(paths)
+    for directory_regexp, media in layouts:
+        candidates = sorted(
+            os.path.dirname(path) for path in paths
+            if path.endswith("/vmlinuz")
+            and re.fullmatch(directory_regexp, os.path.dirname(path))
+            and os.path.dirname(path) + "/initrd.gz" in paths
+        )
+        matching = [
+            directory for directory in candidates
+            if directory.split("/")[1] in (arch_directory, "install")
+        ]
+        if len(candidates) == 1 or matching:
+            directory = (matching or candidates)[0]
+            return BootFiles(directory + "/vmlinuz", directory + "/initrd.gz", media)
+    raise ValueError(f"no installer kernel and initrd found for architecture: {architecture}")
+
+
+class IsoInfo:
+    """Debian version and architecture of an installation ISO image.
+
+    Read from the image contents on first access and cached. The ISO
+    filename is only used as a fallback, for images without Debian
+    metadata."""
+
+    def __init__(self, iso_filename: str):
+        self.filename = iso_filename
+        self._version_architecture: Optional[Tuple[Optional[int], Optional[str]]] = None
+
+    @property
+    def version(self) -> int:
+        """Major Debian version."""
+        version = self._read()[0]
+        return version if version is not None else get_debian_version(self.filename)
+
+    @property
+    def architecture(self) -> str:
+        """Debian architecture."""
+        architecture = self._read()[1]
+        return architecture if architecture is not None else get_debian_architecture(self.filename)
+
+    def _read(self) -> Tuple[Optional[int], Optional[str]]:
+        if self._version_architecture is None:
+            self._version_architecture = (None, None)
+            try:
+                with IsoImage(self.filename) as iso:
+                    disk_info = iso.find_files(["/.disk/info"]).get("/.disk/info")
+                    if disk_info is not None:
+                        self._version_architecture = parse_disk_info(
+                            iso.read(disk_info).decode("utf-8", "replace")
+                        )
+                    if None in self._version_architecture:
+                        self._version_architecture = parse_volume_id(iso.volume_id)
+            except (OSError, ValueError):
+                pass
+        return self._version_architecture
+
+
+def parse_disk_info(disk_info: str) -> Tuple[Optional[int], Optional[str]]:
+    """Parse the Debian version and architecture from an ISO image .disk/info file.
+
+    Example contents: Debian GNU/Linux 10.1.0 "Buster" - Official armhf NETINST 20190908-02:17"""
+    regexp = r"^Debian GNU/Linux ([0-9]+)\.[0-9.]+ .* - \S*[Oo]fficial ([a-z0-9]+) "
+    match = re.search(regexp, disk_info)
+    if not match:
+        return None, None
+    return int(match.group(1)), match.group(2)
+
+
+def parse_volume_id(volume_id: str) -> Tuple[Optional[int], Optional[str]]:
+    """Parse the Debian version and architecture from an ISO image volume ID.
+
+    Example volume ID: Debian 10.1.0 armhf n"""
+    regexp = r"^Debian ([0-9]+)\.[0-9.]+ ([a-z0-9]+)( |$)"
+    match = re.search(regexp, volume_id)
+    if not match:
+        return None, None
+    return int(match.group(1)), match.group(2)
 
 
 def get_debian_version(iso_filename: str) -> int:
@@ -128,20 +528,407 @@ def get_debian_architecture(iso_filename: str) -> str:
     return match.group(1)
 
 
-def iso_extract_file(iso_filename: str, extract_filename: str) -> bytes:
-    """Extract a file from an ISO image and return its contents."""
-    command = ["isoinfo", "-R", "-x", extract_filename, "-i", iso_filename]
-    process = subprocess.run(command, capture_output=True, check=True)
-    extracted: bytes = process.stdout
-    if not extracted:
-        raise ValueError(
-            f"failed to extract file: {extract_filename} from ISO: {iso_filename}"
-        )
+def iso_extract_files_tmp(iso_filename: str, extract_filenames: List[str]) -> List[IO]:
+    """Extract files from an ISO image into named temporary files.
+
+    File contents are copied straight from the image to the temporary files
+    without being buffered in memory."""
+    with IsoImage(iso_filename) as iso:
+        extracted = []
+        for iso_file in iso_find_extractable(iso, extract_filenames):
+            tmp_file = named_tmp(b"")
+            iso.copy_to(iso_file, tmp_file)
+            extracted.append(tmp_file)
     return extracted
 
 
+def iso_extract_files_cached(
+        iso_filename: str,
+        extract_filenames: List[str],
+        cache: CacheConfig,
+    ) -> List[IO]:
+    """Extract files from an ISO image through the boot file cache.
+
+    Cached files are keyed by the digest of the image and the file path.
+    Returns the cached files opened for reading. Each file is opened as
+    soon as it's found or added, because adding the next one may evict it."""
+    boot_cache = FileCache(os.path.join(cache.directory, "boot"), cache.max_size)
+    iso_digest = cached_file_digest(iso_filename, cache)
+    keys = [
+        hashlib.sha256(f"{iso_digest}:{extract_filename}".encode()).hexdigest()
+        for extract_filename in extract_filenames
+    ]
+    opened: Dict[str, IO] = {}
+    missing = {}
+    for extract_filename, key in zip(extract_filenames, keys):
+        if boot_cache.get(key) is None:
+            missing[extract_filename] = key
+        else:
+            opened[key] = boot_cache.open(key)
+    if missing:
+        with IsoImage(iso_filename) as iso:
+            for iso_file, key in zip(iso_find_extractable(iso, list(missing)), missing.values()):
+                boot_cache.put(key, functools.partial(iso.copy_to, iso_file))
+                opened[key] = boot_cache.open(key)
+    return [opened[key] for key in keys]
+
+
+def iso_find_extractable(iso: "IsoImage", extract_filenames: List[str]) -> List[IsoFile]:
+    """Look up regular, non-empty files in an ISO image, in the given order."""
+    found = iso.find_files(extract_filenames)
+    extractable = []
+    for extract_filename in extract_filenames:
+        iso_file = found.get(extract_filename)
+        if iso_file is None or iso_file.is_dir or not iso_file.size:
+            raise ValueError(
+                f"failed to extract file: {extract_filename} from ISO: {iso.filename}"
+            )
+        extractable.append(iso_file)
+    return extractable
+
+
+class IsoImage:
+    """Read-only access to files in an ISO 9660 image with Rock Ridge extensions.
+
+    Supports single extent files only, which is enough for everything that
+    the Debian installer images contain."""
+
+    sector_size = 2048
+
+    def __init__(self, iso_filename: str):
+        self.filename = iso_filename
+        self._file = open(iso_filename, "rb")  # pylint: disable=consider-using-with
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise
+        self._listings: Dict[int, Dict[str, IsoFile]] = {}
+        try:
+            self._read_primary_volume_descriptor()
+        except (ValueError, IndexError, struct.error):
+            self.close()
+            raise
+
+    def __enter__(self) -> "IsoImage":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the memory mapping and close the image file."""
+        self._map.close()
+        self._file.close()
+
+    def find_files(self, paths: Iterable[str]) -> Dict[str, IsoFile]:
+        """Look files up by their absolute paths.
+
+        Directories shared between paths are only read once. Paths that
+        don't exist are omitted from the result."""
+        found = {}
+        for path in paths:
+            iso_file: Optional[IsoFile] = self.root
+            for name in filter(None, path.split("/")):
+                if iso_file is None or not iso_file.is_dir:
+                    iso_file = None
+                    break
+                iso_file = self.listdir(iso_file).get(name)
+            if iso_file is not None:
+                found[path] = iso_file
+        return found
+
+    def read(self, iso_file: IsoFile) -> bytes:
+        """Read the contents of a file."""
+        return self._map[iso_file.offset:iso_file.offset + iso_file.size]
+
+    def copy_to(self, iso_file: IsoFile, output: IO) -> None:
+        """Write the contents of a file at the current position of an output file."""
+        output.flush()
+        position = output.tell()
+        copy_range(self._file.fileno(), output.fileno(), iso_file.offset, iso_file.size, position)
+        output.seek(position + iso_file.size)
+
+    def walk(self, descend: Optional[Callable[[IsoFile], bool]] = None) -> Iterator[IsoFile]:
+        """Iterate over all files and directories in the image.
+
+        Directories are visited in the path table order, which lists parents
+        before their children, so that each directory is read exactly once
+        and its Rock Ridge name is already known from its parent's listing.
+        The optional callback can prevent descending into a directory."""
+        directories = {self.root.offset: self.root}
+        for extent in self._path_table_extents():
+            directory = directories.get(extent * self.sector_size)
+            if directory is None:
+                continue
+            for iso_file in self.listdir(directory).values():
+                yield iso_file
+                if iso_file.is_dir and (descend is None or descend(iso_file)):
+                    directories[iso_file.offset] = iso_file
+
+    def listdir(self, directory: IsoFile) -> Dict[str, IsoFile]:
+        """List directory contents, keyed by file name."""
+        if directory.offset not in self._listings:
+            self._listings[directory.offset] = {
+                iso_file.path.rsplit("/", 1)[1]: iso_file
+                for iso_file in self._read_directory(directory)
+            }
+        return self._listings[directory.offset]
+
+    def _read_primary_volume_descriptor(self) -> None:
+        sector = 16
+        while True:
+            descriptor = self._map[sector * self.sector_size:(sector + 1) * self.sector_size]
+            if len(descriptor) < self.sector_size or descriptor[1:6] != b"CD001":
+                raise ValueError(f"not an ISO 9660 image: {self.filename}")
+            if descriptor[0] == 1:
+                break
+            if descriptor[0] == 255:
+                raise ValueError(f"no primary volume descriptor in ISO: {self.filename}")
+            sector += 1
+        block_size = struct.unpack_from("<H", descriptor, 128)[0]
+        if block_size != self.sector_size:
+            raise ValueError(f"unsupported ISO logical block size: {block_size}")
+        self.volume_id = descriptor[40:72].decode("ascii", "replace").strip()
+        self._path_table_size, self._path_table_sector = struct.unpack_from(
+            "<I4xI", descriptor, 132
+        )
+        root_extent, root_size = struct.unpack_from("<I4xI", descriptor, 156 + 2)
+        self.root = IsoFile("/", root_extent * self.sector_size, root_size, True)
+        # The SUSP "SP" entry of the root directory's "." record tells how
+        # many bytes to skip at the start of each System Use area.
+        self._susp_skip = 0
+        dot_record = self._map[self.root.offset:self.root.offset + self.root.size]
+        for signature, data in self._susp_entries(self._system_use_area(dot_record)):
+            if signature == b"SP" and data[:2] == b"\xbe\xef":
+                self._susp_skip = data[2]
+
+    def _path_table_extents(self) -> Iterator[int]:
+        start = self._path_table_sector * self.sector_size
+        table = self._map[start:start + self._path_table_size]
+        position = 0
+        while position < len(table):
+            name_length, _, extent = struct.unpack_from("<BBI", table, position)
+            yield extent
+            position += 8 + name_length + name_length % 2
+
+    def _read_directory(self, directory: IsoFile) -> Iterator[IsoFile]:
+        data = self._map[directory.offset:directory.offset + directory.size]
+        position = 0
+        while position < len(data):
+            record_length = data[position]
+            if not record_length:
+                # records don't cross sector boundaries, the rest is padding
+                position += self.sector_size - position % self.sector_size
+                continue
+            record = data[position:position + record_length]
+            position += record_length
+            name_length = record[32]
+            iso_name = record[33:33 + name_length]
+            if iso_name in (b"\x00", b"\x01"):
+                continue
+            extent, size = struct.unpack_from("<I4xI", record, 2)
+            is_dir = bool(record[25] & 0x02)
+            name = self._rock_ridge_name(record)
+            if name is None:
+                name = iso_name.decode("ascii", "replace").split(";")[0]
+                if not is_dir:
+                    name = name.rstrip(".")
+            yield IsoFile(
+                directory.path.rstrip("/") + "/" + name,
+                extent * self.sector_size,
+                size,
+                is_dir,
+            )
+
+    def _rock_ridge_name(self, record: bytes) -> Optional[str]:
+        name_parts = []
+        area = self._system_use_area(record)[self._susp_skip:]
+        for signature, data in self._susp_entries(area):
+            if signature == b"NM":
+                name_parts.append(data[1:])
+        if not name_parts:
+            return None
+        return b"".join(name_parts).decode("utf-8", "replace")
+
+    @staticmethod
+    def _system_use_area(record: bytes) -> bytes:
+        name_length = record[32]
+        return record[33 + name_length + (1 - name_length % 2):record[0]]
+
+    def _susp_entries(self, area: bytes) -> Iterator[Tuple[bytes, bytes]]:
+        while area:
+            position = 0
+            continuation = None
+            while position + 4 <= len(area):
+                signature = area[position:position + 2]
+                length = area[position + 2]
+                if length < 4 or signature == b"ST":
+                    break
+                data = area[position + 4:position + length]
+                if signature == b"CE":
+                    sector, offset, size = struct.unpack_from("<I4xI4xI", data)
+                    start = sector * self.sector_size + offset
+                    continuation = self._map[start:start + size]
+                else:
+                    yield signature, data
+                position += length
+            area = continuation or b""
+
+
+def initrd_add_preseed(initrd: IO, preseed_filename: str) -> IO:
+    """Create a copy of an initrd with a preseed configuration file added."""
+    with open(preseed_filename, "rb") as preseed_file:
+        preseed = preseed_file.read()
+    output = named_tmp(b"")
+    write_initrd_with_preseed(initrd, preseed, output)
+    output.flush()
+    return output
+
+
+def initrd_add_preseed_cached(initrd: IO, preseed_filename: str, cache: CacheConfig) -> IO:
+    """Get a copy of a cached initrd with a preseed configuration file added.
+
+    The combined initrds are cached too, keyed by the boot file cache key of
+    the initrd, which identifies its contents, and the preseed file digest.
+    Returns the cached file opened for reading."""
+    with open(preseed_filename, "rb") as preseed_file:
+        preseed = preseed_file.read()
+    initrd_key = os.path.basename(initrd.name)
+    preseed_digest = hashlib.sha256(preseed).hexdigest()
+    key = hashlib.sha256(f"{initrd_key}:{preseed_digest}".encode()).hexdigest()
+    initrd_cache = FileCache(os.path.join(cache.directory, "initrd"), cache.max_size)
+    if initrd_cache.get(key) is None:
+        initrd_cache.put(key, lambda output: write_initrd_with_preseed(initrd, preseed, output))
+    return initrd_cache.open(key)
+
+
+def write_initrd_with_preseed(initrd: IO, preseed: bytes, output: IO) -> None:
+    """Write an initrd with a preseed configuration file added.
+
+    The Linux kernel unpacks concatenated (and separately compressed) cpio
+    archives into the same initramfs, so the original initrd is copied as is
+    and a compressed archive containing /preseed.cfg is appended to it."""
+    output.flush()
+    position = output.tell()
+    initrd_size = os.fstat(initrd.fileno()).st_size
+    copy_range(initrd.fileno(), output.fileno(), 0, initrd_size, position)
+    output.seek(position + initrd_size)
+    with gzip.GzipFile(fileobj=output, mode="wb", mtime=0) as compressed:
+        compressed.write(cpio_archive([("preseed.cfg", preseed)]))
+
+
+def cpio_archive(files: Iterable[Tuple[str, bytes]]) -> bytes:
+    """Create a cpio archive in the "newc" format, as used for initramfs images."""
+
+    def pad(data: bytes) -> bytes:
+        return data + b"\0" * (-len(data) % 4)
+
+    archive = b""
+    entries = [(name, 0o100644, content) for name, content in files]
+    entries.append(("TRAILER!!!", 0, b""))
+    for inode, (name, mode, content) in enumerate(entries, start=1):
+        encoded_name = name.encode() + b"\0"
+        fields = [inode, mode, 0, 0, 1, 0, len(content), 0, 0, 0, 0, len(encoded_name), 0]
+        header = b"070701" + b"".join(b"%08X" % field for field in fields)
+        archive += pad(header + encoded_name) + pad(content)
+    return archive
+
+
 def create_installer_hd(iso_filename: str) -> IO:
     """Create a hard disk image containing the installation ISO."""
+    disk_image = named_tmp(b"")
+    write_installer_hd(iso_filename, disk_image)
+    return disk_image
+
+
+def create_installer_hd_directory(iso_filename: str) -> "tempfile.TemporaryDirectory[str]":
+    """Create a staging directory containing the installation ISO.
+
+    Meant to be exposed to the guest as a QEMU virtual FAT disk. The ISO is
+    hardlinked or reflinked, never copied, so the directory is created on
+    the same filesystem as the ISO if possible. The virtual FAT disk
+    geometry (1024 cylinders, 16 heads, 63 sectors) limits it to 504 MiB,
+    which leaves room for ISO images of up to 500 MiB."""
+    max_iso_size = 500 * 1024 * 1024
+    if os.path.getsize(iso_filename) > max_iso_size:
+        raise ValueError(
+            f"too large for a virtual FAT disk: {iso_filename}, maximum size: {max_iso_size}"
+        )
+    iso_dir = os.path.dirname(os.path.realpath(iso_filename))
+    script_base = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    directory: Optional["tempfile.TemporaryDirectory[str]"] = None
+    # QEMU takes the virtual FAT disk directory from after the last colon
+    if ":" not in iso_dir:
+        with contextlib.suppress(OSError):
+            directory = tempfile.TemporaryDirectory(prefix=f".{script_base}.", dir=iso_dir)
+    if directory is None:
+        directory = tempfile.TemporaryDirectory(prefix=f"{script_base}.")
+    if ":" in directory.name:
+        directory.cleanup()
+        raise ValueError(f"colons are not supported in virtual FAT disk paths: {directory.name}")
+    name = os.path.basename(iso_filename)
+    # the hd-media installer looks for files with the .iso extension
+    if not name.lower().endswith(".iso"):
+        name += ".iso"
+    try:
+        link_or_reflink(iso_filename, os.path.join(directory.name, name))
+    except BaseException:
+        directory.cleanup()
+        raise
+    return directory
+
+
+def link_or_reflink(source_filename: str, target_filename: str) -> None:
+    """Create a hardlink or, failing that, a reflink (copy-on-write clone) of a file."""
+    try:
+        os.link(source_filename, target_filename)
+        return
+    except OSError as error:
+        link_error = error
+    ficlone = 0x40049409
+    with open(source_filename, "rb") as source, open(target_filename, "xb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), ficlone, source.fileno())
+            return
+        except OSError:
+            pass
+    # only reached if the target was created above
+    os.unlink(target_filename)
+    raise ValueError(
+        f"can't link or reflink {source_filename} to {target_filename}: {link_error}"
+    )
+
+
+def create_installer_hd_overlay(iso_filename: str, cache: CacheConfig) -> IO:
+    """Create a disk image overlay on top of a cached installer hard disk image.
+
+    The hard disk image is built once per ISO image digest. Installations
+    get a throwaway qcow2 overlay, so that the cached image is never
+    modified."""
+    installer_hd_cache = FileCache(os.path.join(cache.directory, "installer-hd"), cache.max_size)
+    key = cached_file_digest(iso_filename, cache)
+    if installer_hd_cache.get(key) is None:
+        installer_hd_cache.put(key, lambda output: write_installer_hd(iso_filename, output))
+    base = installer_hd_cache.open(key)
+    overlay = named_tmp(b"")
+    command = [
+        "qemu-img", "create", "-q", "-f", "qcow2",
+        # relative backing file paths are resolved relative to the overlay
+        "-b", os.path.abspath(base.name), "-F", "raw",
+        overlay.name,
+    ]
+    subprocess.run(command, check=True)
+    # keep the base image link for as long as the overlay
+    weakref.finalize(overlay, base.close)
+    return overlay
+
+
+def write_installer_hd(iso_filename: str, disk_image: IO) -> None:
+    """Write a hard disk image containing the installation ISO.
+
+    The filesystem is created directly at the partition offset of a sparse
+    disk image, so that the ISO is only copied once."""
 
     def calculate_fs_size(iso_size: int) -> int:
         fs_size = int(round(iso_size * 1.1))
@@ -150,30 +937,33 @@ def create_installer_hd(iso_filename: str) -> IO:
 
     header_size = 2048 * 512
     fs_size = calculate_fs_size(os.stat(iso_filename).st_size)
-    fs_image = named_tmp(b"")
-    fs_image.truncate(fs_size)
-    subprocess.run(["/sbin/mkfs.ext2", fs_image.name], check=True)
+    disk_image.truncate(header_size + fs_size)
+    disk_image.flush()
+    subprocess.run(
+        ["/sbin/mkfs.ext2", "-E", f"offset={header_size}", disk_image.name, f"{fs_size // 1024}k"],
+        check=True,
+    )
+    # write the partition table after mkfs, which may discard blocks
+    disk_image.seek(0)
+    disk_image.write(mbr_partition_table(header_size // 512, fs_size // 512))
+    disk_image.flush()
     fs_iso_filename = os.path.basename(iso_filename)
-    debugfs_command(fs_image.name, f"write {iso_filename} {fs_iso_filename}")
-    disk_size = fs_size + header_size
-    disk_image = named_tmp(b"")
-    disk_image.truncate(disk_size)
-    sfdisk_script = "label: dos\n,,L\nwrite\n"
-    sfdisk_cmd = ["/sbin/sfdisk", disk_image.name]
-    process = subprocess.Popen(
-        sfdisk_cmd,
-        universal_newlines=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
+    debugfs_command(disk_image.name, f"write {iso_filename} {fs_iso_filename}", header_size)
+
+
+def mbr_partition_table(
+        start_sector: int,
+        size_in_sectors: int,
+        partition_type: int = 0x83,
+    ) -> bytes:
+    """Create a DOS partition table (MBR) with a single, non-bootable partition.
+
+    CHS addresses are set to the maximum values, which means "use LBA"."""
+    entry = struct.pack(
+        "<B3sB3sII", 0x00, b"\xfe\xff\xff", partition_type, b"\xfe\xff\xff",
+        start_sector, size_in_sectors,
     )
-    stdout, stderr = process.communicate(sfdisk_script)
-    if process.returncode != 0:
-        raise subprocess.CalledProcessError(process.returncode, sfdisk_cmd, stdout, stderr)
-    fs_image.seek(0)
-    disk_image.seek(header_size)
-    shutil.copyfileobj(fs_image, disk_image)
-    return disk_image
+    return bytes(446) + entry + bytes(16 * 3) + b"\x55\xaa"
 
 
 def create_image(filename: str, size: str) -> None:
@@ -184,131 +974,948 @@ def create_image(filename: str, size: str) -> None:
     subprocess.run(command, check=True)
 
 
-def extract_boot_files(image_filename: str) -> None:
+def extract_boot_files(image_filename: str, cache: Optional[CacheConfig] = None) -> None:
     """Extract the Linux kernel and initrd files from a QEMU VM image.
 
-    Will not overwrite an existing file."""
+    qcow2 and raw images are read directly, other formats through qemu-nbd.
+    Without qemu-nbd only the boot partition is converted to raw. With a
+    cache, the files are deduplicated through its content store. Will not
+    overwrite an existing file."""
     if not os.path.exists(image_filename):
         raise ValueError(f"file not found: {image_filename}")
     image_base, _ = os.path.splitext(image_filename)
-    kernel_filename = image_base + ".kernel"
-    initrd_filename = image_base + ".initrd"
+    output_filenames = [image_base + ".kernel", image_base + ".initrd"]
+    for output_filename in output_filenames:
+        if os.path.exists(output_filename):
+            raise ValueError(f"already exists: {output_filename}")
+    tmp_base = os.path.basename(image_base)
     # put temporary files on the same filesystem, because they might be too
     # large to fit elsewhere
     tmp_dir_base = os.path.dirname(os.path.realpath(image_filename))
     with tempfile.TemporaryDirectory(dir=tmp_dir_base) as tmp_dir:
-        raw_filename = os.path.join(tmp_dir, image_base + ".raw")
-        partition_filename = os.path.join(tmp_dir, image_base + ".bootable")
-        image_to_raw(image_filename, raw_filename)
-        extract_boot_partition(raw_filename, partition_filename)
-        extract_partition_boot_files(partition_filename, kernel_filename, initrd_filename)
+        partition_filename = os.path.join(tmp_dir, tmp_base + ".bootable")
+        if cache is None:
+            kernel_filename, initrd_filename = output_filenames
+        else:
+            kernel_filename = os.path.join(tmp_dir, tmp_base + ".kernel")
+            initrd_filename = os.path.join(tmp_dir, tmp_base + ".initrd")
+        image = open_disk_image(image_filename)
+        if image is None:
+            convert_boot_partition(image_filename, partition_filename)
+            image = RawImage(partition_filename)
+            converted = True
+        else:
+            converted = False
+        with image:
+            partition_offset = 0
+            if not converted:
+                partition = find_boot_partition(
+                    list_partitions(image), functools.partial(partition_has_kernel, image)
+                )
+                partition_offset = partition.start_sector * partition.sector_size
+            try:
+                filesystem = ExtFilesystem(image, partition_offset)
+            except ValueError:
+                # not supported natively, fall back to debugfs
+                if partition_offset:
+                    extract_image_boot_partition(image, partition_filename)
+                extract_partition_boot_files(partition_filename, kernel_filename, initrd_filename)
+            else:
+                extract_filesystem_boot_files(filesystem, kernel_filename, initrd_filename)
+        if cache is not None:
+            store = ContentStore(os.path.join(cache.directory, "store"))
+            store.link(kernel_filename, output_filenames[0])
+            store.link(initrd_filename, output_filenames[1])
 
 
-def image_to_raw(input_filename: str, output_filename: str) -> None:
-    """Convert a QEMU disk image to raw format.
+def partition_has_kernel(image: "BlockSource", partition: Partition) -> bool:
+    """Check whether a partition has a natively readable filesystem with /vmlinuz."""
+    try:
+        ExtFilesystem(image, partition.start_sector * partition.sector_size).lookup("/vmlinuz")
+    except ValueError:
+        return False
+    return True
 
-    Will not overwrite an existing file."""
-    if not os.path.exists(input_filename):
-        raise ValueError(f"file not found: {input_filename}")
+
+def open_disk_image(image_filename: str) -> Optional["BlockSource"]:
+    """Open a disk image for direct reading.
+
+    Returns None if the format is neither read natively nor through qemu-nbd,
+    because qemu-nbd is not installed."""
+    try:
+        return Qcow2Image(image_filename)
+    except ValueError:
+        pass
+    image_format = image_info(image_filename)["format"]
+    if image_format == "raw":
+        return RawImage(image_filename)
+    try:
+        return NbdImage(image_filename, image_format)
+    except FileNotFoundError:
+        # qemu-nbd is not installed
+        return None
+
+
+def image_info(image_filename: str) -> Dict[str, Any]:
+    """Get information about a QEMU disk image, like its format and virtual size."""
+    command = ["qemu-img", "info", "--output=json", image_filename]
+    process = subprocess.run(command, capture_output=True, text=True, check=True)
+    info: Dict[str, Any] = json.loads(process.stdout)
+    return info
+
+
+def convert_boot_partition(image_filename: str, output_filename: str) -> None:
+    """Convert the Linux boot partition of a QEMU disk image to raw format.
+
+    Only the partition table area and the partition itself are converted.
+    Will not overwrite an existing file. Does not support LVM or logical
+    partitions."""
     if os.path.exists(output_filename):
         raise ValueError(f"already exists: {output_filename}")
-    command = ["qemu-img", "convert", "-O", "raw", input_filename, output_filename]
+    info = image_info(image_filename)
+    table_filename = output_filename + ".table"
+    table_size = min(info["virtual-size"], 2048 * 512)
+    convert_image_range(image_filename, info["format"], table_filename, 0, table_size)
+    try:
+        with RawImage(table_filename) as table:
+            partition = find_boot_partition(list_partitions(table))
+    finally:
+        os.unlink(table_filename)
+    convert_image_range(
+        image_filename,
+        info["format"],
+        output_filename,
+        partition.start_sector * partition.sector_size,
+        partition.size_in_sectors * partition.sector_size,
+    )
+
+
+def convert_image_range(
+        image_filename: str,
+        image_format: str,
+        output_filename: str,
+        offset: int,
+        size: int,
+    ) -> None:
+    """Convert a byte range of a QEMU disk image to a sparse raw file.
+
+    Uses the raw format driver's offset and size options on top of the
+    image's format driver, with parallel coroutines and out-of-order
+    writes. Will not overwrite an existing file."""
+    if os.path.exists(output_filename):
+        raise ValueError(f"already exists: {output_filename}")
+    # commas in option values are escaped by doubling them
+    escaped_filename = image_filename.replace(",", ",,")
+    image_opts = ",".join([
+        "driver=raw",
+        f"offset={offset}",
+        f"size={size}",
+        f"file.driver={image_format}",
+        f"file.file.filename={escaped_filename}",
+    ])
+    command = [
+        "qemu-img", "convert", "-m", "8", "-W",
+        "--image-opts", image_opts,
+        "-O", "raw", output_filename,
+    ]
     subprocess.run(command, check=True)
 
 
-def extract_boot_partition(image_filename: str, output_filename: str) -> None:
-    """Extract the first bootable Linux partition from a disk image file.
+def extract_image_boot_partition(image: "BlockSource", output_filename: str) -> None:
+    """Extract the Linux boot partition from a disk image.
 
+    Only the partition table and the partition's allocated data are read.
     Will not overwrite an existing file. Does not support LVM."""
-    if not os.path.exists(image_filename):
-        raise ValueError(f"file not found: {image_filename}")
     if os.path.exists(output_filename):
         raise ValueError(f"already exists: {output_filename}")
-    for partition in list_partitions(image_filename):
-        if partition.type == "Linux" and partition.bootable:
-            # use dd for sparse file support
-            command = [
-                "dd",
-                f"if={image_filename}",
-                f"of={output_filename}",
-                f"bs={partition.sector_size}",
-                f"skip={partition.start_sector}",
-                f"count={partition.size_in_sectors}",
-                "conv=sparse",
-            ]
-            subprocess.run(command, check=True, stderr=subprocess.DEVNULL)
-            return
-    raise ValueError("no bootable Linux partition found")
+    partition = find_boot_partition(list_partitions(image))
+    write_image_range(
+        image,
+        output_filename,
+        partition.start_sector * partition.sector_size,
+        partition.size_in_sectors * partition.sector_size,
+    )
 
 
-def list_partitions(image_filename: str) -> Iterable[Partition]:
-    """List partitions in a disk image.
+def find_boot_partition(
+        partitions: Iterable[Partition],
+        has_kernel: Optional[Callable[[Partition], bool]] = None,
+    ) -> Partition:
+    """Find the Linux partition containing the kernel.
 
-    Does not support LVM."""
-    if not os.path.exists(image_filename):
-        raise ValueError(f"file not found: {image_filename}")
-    parser = [
-        ("Type", r".+", lambda s: s.strip()),
-        ("Start", r"[0-9]+", int),
-        ("Sectors", r"[0-9]+", int),
-        ("Boot", r"\*{0,1}", bool),
+    Bootable partitions are tried first, then the other Linux partitions,
+    because the Debian installer doesn't set the legacy BIOS bootable
+    attribute on GPT partitions. Without a has_kernel check, the first
+    candidate is picked. With one, the first candidate which passes it,
+    or the first candidate if none does."""
+    linux_partitions = [
+        partition for partition in partitions if partition.type in LINUX_PARTITION_TYPES
     ]
-    column_spec = ",".join(header for header, _, _ in parser)
-    header_regexp = r"\s+".join(header for header, _, _ in parser)
-    data_regexp = r"\s+".join(f"(?P<{header}>{regexp})" for header, regexp, _ in parser)
-    postprocessors = {header: func for header, _, func in parser}
-    command = ["/sbin/fdisk", "-l", "-o", column_spec, image_filename]
-    process = subprocess.run(command, capture_output=True, text=True, check=True)
-    sector_size = parse_fdisk_sector_size(process.stdout)
-    units = parse_fdisk_units(process.stdout)
-    if sector_size != units:
-        raise ValueError(
-            f"partition table sector size and unit size differ: {sector_size} != {units}"
+    if not linux_partitions:
+        raise ValueError("no Linux partition found")
+    candidates = sorted(linux_partitions, key=lambda partition: not partition.bootable)
+    if has_kernel is not None:
+        for partition in candidates:
+            if has_kernel(partition):
+                return partition
+    return candidates[0]
+
+
+def write_image_range(
+        image: "BlockSource",
+        output_filename: str,
+        offset: int,
+        size: int,
+    ) -> CopyStats:
+    """Write a byte range of a disk image to a sparse file.
+
+    Will not overwrite an existing file."""
+    with open(output_filename, "xb") as output:
+        output.truncate(size)
+        stats = image.copy_to(output.fileno(), offset, size, 0)
+    logger.info(
+        "%s: copied %d bytes, skipped %d bytes of holes",
+        output_filename, stats.copied, stats.skipped,
+    )
+    return stats
+
+
+class BlockSource(abc.ABC):
+    """Random access to the contents of a disk image."""
+
+    size = 0
+
+    def __enter__(self) -> "BlockSource":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release resources associated with the image."""
+
+    @abc.abstractmethod
+    def read(self, offset: int, length: int) -> bytes:
+        """Read bytes at an offset. Reading past the end returns fewer bytes."""
+
+    def allocated_ranges(self, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        """List (start, end) byte ranges within a range which may contain data.
+
+        Anything outside the listed ranges reads as zeros."""
+        yield start, min(end, self.size)
+
+    def copy_to(self, output_fd: int, offset: int, size: int, output_offset: int) -> CopyStats:
+        """Copy a byte range to a file, skipping ranges which read as zeros.
+
+        The skipped ranges of the output are not written, so they should
+        already read as zeros, e.g. in a new or truncated file."""
+        copied = 0
+        for start, end in self.allocated_ranges(offset, offset + size):
+            position = start
+            while position < end:
+                length = min(end - position, 4 * 1024 * 1024)
+                data = self.read(position, length)
+                os.pwrite(output_fd, data, position - offset + output_offset)
+                position += length
+            copied += end - start
+        return CopyStats(copied, size - copied)
+
+
+class RawImage(BlockSource):
+    """Read-only access to a raw disk image."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, "rb")  # pylint: disable=consider-using-with
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def close(self) -> None:
+        self._file.close()
+
+    def read(self, offset: int, length: int) -> bytes:
+        return os.pread(self._file.fileno(), length, offset)
+
+    def allocated_ranges(self, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        return data_ranges(self._file.fileno(), start, min(end, self.size))
+
+    def copy_to(self, output_fd: int, offset: int, size: int, output_offset: int) -> CopyStats:
+        size = max(0, min(size, self.size - offset))
+        return sparse_copy(self._file.fileno(), output_fd, offset, size, output_offset)
+
+
+class Qcow2Image(BlockSource):
+    """Read-only access to the guest contents of a qcow2 disk image.
+
+    Unallocated and zero clusters read as zeros. Supports zlib compressed
+    clusters. Does not support backing files, encryption, external data
+    files or extended L2 entries."""
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = open(filename, "rb")  # pylint: disable=consider-using-with
+        try:
+            self._read_header()
+        except (ValueError, struct.error):
+            self._file.close()
+            raise
+        self._l2_tables: Dict[int, Tuple[int, ...]] = {}
+
+    def close(self) -> None:
+        self._file.close()
+
+    def read(self, offset: int, length: int) -> bytes:
+        length = max(0, min(length, self.size - offset))
+        chunks = []
+        while length > 0:
+            in_cluster = offset & (self.cluster_size - 1)
+            chunk_length = min(length, self.cluster_size - in_cluster)
+            entry = self._l2_entry(offset)
+            if entry & self._compressed_flag:
+                cluster = self._read_compressed_cluster(entry)
+                chunks.append(cluster[in_cluster:in_cluster + chunk_length])
+            elif entry & 1 or not entry & self._offset_mask:
+                chunks.append(bytes(chunk_length))
+            else:
+                host_offset = (entry & self._offset_mask) + in_cluster
+                chunks.append(os.pread(self._file.fileno(), chunk_length, host_offset))
+            offset += chunk_length
+            length -= chunk_length
+        return b"".join(chunks)
+
+    def allocated_ranges(self, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        end = min(end, self.size)
+        range_start = None
+        offset = start - (start & (self.cluster_size - 1))
+        while offset < end:
+            entry = self._l2_entry(offset)
+            allocated = bool(entry & self._compressed_flag) or (
+                not entry & 1 and bool(entry & self._offset_mask)
+            )
+            if allocated and range_start is None:
+                range_start = max(offset, start)
+            elif not allocated and range_start is not None:
+                yield range_start, offset
+                range_start = None
+            offset += self.cluster_size
+        if range_start is not None:
+            yield range_start, end
+
+    def _read_header(self) -> None:
+        header = os.pread(self._file.fileno(), 112, 0)
+        magic, version, backing_file_offset = struct.unpack_from(">4sIQ", header)
+        if magic != b"QFI\xfb":
+            raise ValueError(f"not a qcow2 image: {self.filename}")
+        if version not in (2, 3):
+            raise ValueError(f"unsupported qcow2 version: {version}")
+        (
+            cluster_bits, self.size, crypt_method, l1_size, l1_table_offset,
+        ) = struct.unpack_from(">4xIQIIQ", header, 16)
+        if backing_file_offset:
+            raise ValueError(f"qcow2 images with backing files are not supported: {self.filename}")
+        if crypt_method:
+            raise ValueError(f"encrypted qcow2 images are not supported: {self.filename}")
+        if version == 3:
+            incompatible_features, = struct.unpack_from(">Q", header, 72)
+            # only the "dirty" bit is safe to ignore for reading
+            if incompatible_features & ~1:
+                raise ValueError(
+                    f"unsupported qcow2 incompatible features: {incompatible_features:#x}"
+                )
+        self.cluster_size = 1 << cluster_bits
+        self._cluster_bits: int = cluster_bits
+        self._l2_bits: int = cluster_bits - 3
+        self._offset_mask = 0x00fffffffffffe00
+        self._compressed_flag = 1 << 62
+        l1_table = os.pread(self._file.fileno(), l1_size * 8, l1_table_offset)
+        self._l1_table = struct.unpack(f">{l1_size}Q", l1_table)
+
+    def _l2_entry(self, offset: int) -> int:
+        cluster_index = offset >> self._cluster_bits
+        l1_index = cluster_index >> self._l2_bits
+        if l1_index >= len(self._l1_table):
+            return 0
+        l2_offset = self._l1_table[l1_index] & self._offset_mask
+        if not l2_offset:
+            return 0
+        if l2_offset not in self._l2_tables:
+            entries = self.cluster_size // 8
+            l2_table = os.pread(self._file.fileno(), self.cluster_size, l2_offset)
+            self._l2_tables[l2_offset] = struct.unpack(f">{entries}Q", l2_table)
+        return self._l2_tables[l2_offset][cluster_index & ((1 << self._l2_bits) - 1)]
+
+    def _read_compressed_cluster(self, entry: int) -> bytes:
+        offset_bits = 62 - (self._cluster_bits - 8)
+        host_offset = entry & ((1 << offset_bits) - 1)
+        additional_sectors = (entry >> offset_bits) & ((1 << (self._cluster_bits - 8)) - 1)
+        compressed_size = (additional_sectors + 1) * 512 - (host_offset & 511)
+        compressed = os.pread(self._file.fileno(), compressed_size, host_offset)
+        return zlib.decompressobj(-12).decompress(compressed, self.cluster_size)
+
+
+NBD_OPTS_MAGIC = 0x49484156454F5054  # "IHAVEOPT"
+NBD_REP_MAGIC = 0x3E889045565A9
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+NBD_STRUCTURED_REPLY_MAGIC = 0x668E33EF
+NBD_FLAG_FIXED_NEWSTYLE = 1
+NBD_FLAG_NO_ZEROES = 2
+NBD_OPT_GO = 7
+NBD_OPT_STRUCTURED_REPLY = 8
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_INFO_EXPORT = 0
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+NBD_REPLY_FLAG_DONE = 1
+NBD_REPLY_TYPE_NONE = 0
+NBD_REPLY_TYPE_OFFSET_DATA = 1
+NBD_REPLY_TYPE_OFFSET_HOLE = 2
+
+
+class NbdClient:
+    """A minimal read-only NBD client.
+
+    Uses the fixed newstyle handshake and structured replies, if the server
+    supports them. Reads are split into requests which are sent in batches
+    and kept in flight together, so that the server can process them while
+    earlier replies are being received."""
+
+    def __init__(
+            self,
+            sock: socket.socket,
+            export_name: str = "",
+            request_size: int = 2 * 1024 * 1024,
+            max_in_flight: int = 16,
+        ):
+        self._socket = sock
+        self._request_size = request_size
+        self._max_in_flight = max_in_flight
+        self._next_handle = 1
+        self.structured_replies = False
+        self.size = 0
+        self._handshake(export_name.encode())
+
+    def close(self) -> None:
+        """Disconnect from the server."""
+        try:
+            self._socket.sendall(self._request(NBD_CMD_DISC, 0, 0, 0))
+        except OSError:
+            pass
+        self._socket.close()
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Read bytes at an offset. Reading past the end returns fewer bytes."""
+        length = max(0, min(length, self.size - offset))
+        buffer = bytearray(length)
+        requests = [
+            (position, min(self._request_size, offset + length - position))
+            for position in range(offset, offset + length, self._request_size)
+        ]
+        for batch_start in range(0, len(requests), self._max_in_flight):
+            batch = requests[batch_start:batch_start + self._max_in_flight]
+            pending: Dict[int, Tuple[int, int]] = {}
+            messages = []
+            for request_offset, request_length in batch:
+                handle = self._next_handle
+                self._next_handle += 1
+                pending[handle] = (request_offset, request_length)
+                messages.append(
+                    self._request(NBD_CMD_READ, handle, request_offset, request_length)
+                )
+            self._socket.sendall(b"".join(messages))
+            while pending:
+                self._receive_reply(pending, buffer, offset)
+        return bytes(buffer)
+
+    def _handshake(self, export_name: bytes) -> None:
+        magic, opts_magic, flags = struct.unpack(">8sQH", self._receive(18))
+        if magic != b"NBDMAGIC" or opts_magic != NBD_OPTS_MAGIC:
+            raise ValueError("not a newstyle NBD server")
+        if not flags & NBD_FLAG_FIXED_NEWSTYLE:
+            raise ValueError("NBD server does not support fixed newstyle negotiation")
+        client_flags = flags & (NBD_FLAG_FIXED_NEWSTYLE | NBD_FLAG_NO_ZEROES)
+        self._socket.sendall(struct.pack(">I", client_flags))
+        self._send_option(NBD_OPT_STRUCTURED_REPLY, b"")
+        reply_type, _ = self._receive_option_reply(NBD_OPT_STRUCTURED_REPLY)
+        self.structured_replies = reply_type == NBD_REP_ACK
+        data = struct.pack(">I", len(export_name)) + export_name + struct.pack(">H", 0)
+        self._send_option(NBD_OPT_GO, data)
+        while True:
+            reply_type, reply = self._receive_option_reply(NBD_OPT_GO)
+            if reply_type == NBD_REP_ACK:
+                break
+            if reply_type & (1 << 31):
+                raise ValueError(f"NBD export negotiation failed: {reply_type:#x} {reply!r}")
+            if reply_type == NBD_REP_INFO and reply[:2] == struct.pack(">H", NBD_INFO_EXPORT):
+                self.size, _ = struct.unpack(">QH", reply[2:12])
+
+    def _send_option(self, option: int, data: bytes) -> None:
+        self._socket.sendall(struct.pack(">QII", NBD_OPTS_MAGIC, option, len(data)) + data)
+
+    def _receive_option_reply(self, option: int) -> Tuple[int, bytes]:
+        magic, reply_option, reply_type, length = struct.unpack(">QIII", self._receive(20))
+        if magic != NBD_REP_MAGIC or reply_option != option:
+            raise ValueError("invalid NBD option reply")
+        return reply_type, self._receive(length)
+
+    @staticmethod
+    def _request(command: int, handle: int, offset: int, length: int) -> bytes:
+        return struct.pack(">IHHQQI", NBD_REQUEST_MAGIC, 0, command, handle, offset, length)
+
+    def _receive_reply(
+            self,
+            pending: Dict[int, Tuple[int, int]],
+            buffer: bytearray,
+            buffer_offset: int,
+        ) -> None:
+        magic, = struct.unpack(">I", self._receive(4))
+        if magic == NBD_SIMPLE_REPLY_MAGIC:
+            error, handle = struct.unpack(">IQ", self._receive(12))
+            if error:
+                raise OSError(error, f"NBD read failed: {os.strerror(error)}")
+            request_offset, request_length = pending.pop(handle)
+            start = request_offset - buffer_offset
+            self._receive_into(memoryview(buffer)[start:start + request_length])
+            return
+        if magic != NBD_STRUCTURED_REPLY_MAGIC:
+            raise ValueError(f"invalid NBD reply magic: {magic:#x}")
+        flags, reply_type, handle, length = struct.unpack(">HHQI", self._receive(16))
+        if reply_type == NBD_REPLY_TYPE_OFFSET_DATA:
+            chunk_offset, = struct.unpack(">Q", self._receive(8))
+            start = chunk_offset - buffer_offset
+            self._receive_into(memoryview(buffer)[start:start + length - 8])
+        elif reply_type == NBD_REPLY_TYPE_OFFSET_HOLE:
+            # the buffer is already zero filled
+            self._receive(length)
+        elif reply_type & (1 << 15):
+            payload = self._receive(length)
+            error, = struct.unpack(">I", payload[:4])
+            raise OSError(error, f"NBD read failed: {payload[6:].decode(errors='replace')}")
+        elif reply_type != NBD_REPLY_TYPE_NONE:
+            self._receive(length)
+        if flags & NBD_REPLY_FLAG_DONE:
+            pending.pop(handle)
+
+    def _receive(self, length: int) -> bytes:
+        buffer = bytearray(length)
+        self._receive_into(memoryview(buffer))
+        return bytes(buffer)
+
+    def _receive_into(self, view: memoryview) -> None:
+        position = 0
+        while position < len(view):
+            received = self._socket.recv_into(view[position:])
+            if not received:
+                raise ValueError("NBD server closed the connection")
+            position += received
+
+
+class NbdImage(BlockSource):
+    """Read-only access to the guest contents of any disk image QEMU supports.
+
+    Starts qemu-nbd on a private Unix socket and reads the image with
+    NbdClient, so neither the nbd kernel module nor root is needed."""
+
+    def __init__(self, filename: str, image_format: Optional[str] = None, timeout: float = 30):
+        self.filename = filename
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="preseed_install_nbd.")
+        socket_path = os.path.join(self._tmp_dir.name, "nbd.sock")
+        command = ["qemu-nbd", "--read-only", "--shared=1", f"--socket={socket_path}"]
+        if image_format is not None:
+            command.append(f"--format={image_format}")
+        command.append(filename)
+        # pylint: disable=consider-using-with
+        self._process = subprocess.Popen(command, stdin=subprocess.DEVNULL)
+        try:
+            self._client = NbdClient(self._connect(socket_path, timeout))
+        except BaseException:
+            self._process.terminate()
+            self._stop()
+            raise
+        self.size = self._client.size
+
+    def close(self) -> None:
+        self._client.close()
+        self._stop()
+
+    def read(self, offset: int, length: int) -> bytes:
+        return self._client.read(offset, length)
+
+    def _connect(self, socket_path: str, timeout: float) -> socket.socket:
+        deadline = time.monotonic() + timeout
+        while True:
+            if self._process.poll() is not None:
+                raise ValueError(f"qemu-nbd failed for {self.filename}")
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(socket_path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise ValueError(f"timed out waiting for qemu-nbd: {self.filename}")
+                time.sleep(0.05)
+
+    def _stop(self) -> None:
+        # with --shared=1 and without --persistent qemu-nbd exits after the
+        # client disconnects
+        try:
+            self._process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._process.terminate()
+            self._process.wait()
+        self._tmp_dir.cleanup()
+
+
+def list_partitions(image: "BlockSource", sector_size: int = 512) -> Iterator[Partition]:
+    """List partitions in a disk image with a DOS (MBR) or GPT partition table.
+
+    Includes logical partitions. Partition types are named like fdisk names
+    them. Does not support LVM."""
+    mbr = image.read(0, sector_size)
+    if len(mbr) < 512 or mbr[510:512] != b"\x55\xaa":
+        raise ValueError("no partition table found")
+    entries = list(parse_mbr_entries(mbr))
+    if any(partition_type == 0xee for partition_type, _, _, _ in entries):
+        yield from list_gpt_partitions(image, sector_size)
+        return
+    for partition_type, start_sector, size_in_sectors, bootable in entries:
+        yield Partition(
+            type=MBR_PARTITION_TYPES.get(partition_type, f"{partition_type:#04x}"),
+            sector_size=sector_size,
+            start_sector=start_sector,
+            size_in_sectors=size_in_sectors,
+            bootable=bootable,
         )
-    in_list = False
-    for line in process.stdout.splitlines():
-        if re.fullmatch(header_regexp, line):
-            in_list = True
-            continue
-        if in_list:
-            match = re.fullmatch(data_regexp, line)
-            if not match:
-                raise ValueError(f"unable to parse partition line: {line}")
-            parsed = {
-                header: postprocessors[header](value)  # type: ignore
-                for header, value in match.groupdict().items()
-            }
+        if partition_type in MBR_EXTENDED_PARTITION_TYPES:
+            yield from list_logical_partitions(image, sector_size, start_sector)
+
+
+def list_logical_partitions(
+        image: "BlockSource",
+        sector_size: int,
+        extended_start_sector: int,
+    ) -> Iterator[Partition]:
+    """List logical partitions by following the chain of extended boot records.
+
+    The logical partition entry of each EBR is relative to the EBR, the link
+    to the next EBR is relative to the start of the extended partition."""
+    ebr_sector = extended_start_sector
+    visited = set()
+    while ebr_sector not in visited:
+        visited.add(ebr_sector)
+        ebr = image.read(ebr_sector * sector_size, sector_size)
+        if len(ebr) < 512 or ebr[510:512] != b"\x55\xaa":
+            return
+        entries = list(parse_mbr_entries(ebr, skip_empty=False))
+        partition_type, start_sector, size_in_sectors, bootable = entries[0]
+        if partition_type:
             yield Partition(
+                type=MBR_PARTITION_TYPES.get(partition_type, f"{partition_type:#04x}"),
                 sector_size=sector_size,
-                type=parsed["Type"],
-                start_sector=parsed["Start"],
-                size_in_sectors=parsed["Sectors"],
-                bootable=parsed["Boot"],
+                start_sector=ebr_sector + start_sector,
+                size_in_sectors=size_in_sectors,
+                bootable=bootable,
             )
+        next_type, next_start_sector, _, _ = entries[1]
+        if next_type not in MBR_EXTENDED_PARTITION_TYPES:
+            return
+        ebr_sector = extended_start_sector + next_start_sector
 
 
-def parse_fdisk_units(fdisk_output: str) -> int:
-    """Parse unit size in bytes from fdisk output."""
-    regexp = r"^Units: sectors of [0-9]+ \* [0-9]+ = ([0-9]+) bytes$"
-    match = re.search(regexp, fdisk_output, re.MULTILINE)
-    if not match:
-        raise ValueError("can't parse partition table units")
-    return int(match.group(1))
+def parse_mbr_entries(
+        sector: bytes,
+        skip_empty: bool = True,
+    ) -> Iterator[Tuple[int, int, int, bool]]:
+    """Parse the (type, start sector, size in sectors, bootable) entries of an MBR or EBR."""
+    for index in range(4):
+        status, partition_type, start_sector, size_in_sectors = struct.unpack_from(
+            "<B3xB3xII", sector, 446 + index * 16
+        )
+        if partition_type or not skip_empty:
+            yield partition_type, start_sector, size_in_sectors, bool(status & 0x80)
 
 
-def parse_fdisk_sector_size(fdisk_output: str) -> int:
-    """Parse sector size in bytes from fdisk output."""
-    regexp = r"^Sector size \(logical/physical\): ([0-9]+) bytes / ([0-9]+) bytes"
-    match = re.search(regexp, fdisk_output, re.MULTILINE)
-    if not match:
-        raise ValueError("can't parse partition table sector size")
-    logical = match.group(1)
-    physical = match.group(2)
-    if logical != physical:
-        raise ValueError(
-            f"partition table logical and physical sector sizes differ: {logical} != {physical}"
+def list_gpt_partitions(image: "BlockSource", sector_size: int) -> Iterator[Partition]:
+    """List partitions in a GPT partition table.
+
+    Checks the header and partition entry array checksums. Does not fall
+    back to the backup table."""
+    header = image.read(sector_size, sector_size)
+    if header[:8] != b"EFI PART":
+        raise ValueError("no GPT header found")
+    header_size, header_crc = struct.unpack_from("<II", header, 12)
+    if zlib.crc32(header[:16] + b"\0\0\0\0" + header[20:header_size]) != header_crc:
+        raise ValueError("GPT header checksum mismatch")
+    entries_lba, entry_count, entry_size, entries_crc = struct.unpack_from("<QIII", header, 72)
+    entries = image.read(entries_lba * sector_size, entry_count * entry_size)
+    if zlib.crc32(entries) != entries_crc:
+        raise ValueError("GPT partition entries checksum mismatch")
+    for index in range(entry_count):
+        entry = entries[index * entry_size:(index + 1) * entry_size]
+        type_guid = str(uuid.UUID(bytes_le=entry[:16])).upper()
+        if type_guid == "00000000-0000-0000-0000-000000000000":
+            continue
+        first_lba, last_lba, attributes = struct.unpack_from("<QQQ", entry, 32)
+        yield Partition(
+            type=GPT_PARTITION_TYPES.get(type_guid, type_guid),
+            sector_size=sector_size,
+            start_sector=first_lba,
+            size_in_sectors=last_lba - first_lba + 1,
+            bootable=bool(attributes & (1 << 2)),
+        )
+
+
+def extract_filesystem_boot_files(
+        filesystem: "ExtFilesystem",
+        output_kernel_filename: str,
+        output_initrd_filename: str,
+    ) -> None:
+    """Extract the Linux kernel and initrd files from a filesystem.
+
+    Will not overwrite an existing file."""
+    if os.path.exists(output_kernel_filename):
+        raise ValueError(f"already exists: {output_kernel_filename}")
+    if os.path.exists(output_initrd_filename):
+        raise ValueError(f"already exists: {output_initrd_filename}")
+    filesystem.extract("/vmlinuz", output_kernel_filename)
+    filesystem.extract("/initrd.img", output_initrd_filename)
+
+
+class ExtInode(NamedTuple):
+    number: int
+    mode: int
+    size: int
+    flags: int
+    data_blocks: int
+    block: bytes
+
+
+class ExtFilesystem:
+    """Read-only access to files in an ext2, ext3 or ext4 filesystem.
+
+    Supports block maps, extent trees, and fast and slow symlinks. Does not
+    support inline data, encryption, compression or meta block groups. Does
+    not replay the journal."""
+
+    supported_incompat_features = (
+        0x0002  # filetype
+        | 0x0004  # needs journal recovery
+        | 0x0040  # extents
+        | 0x0080  # 64bit
+        | 0x0100  # multiple mount protection
+        | 0x0200  # flex_bg
+        | 0x0400  # large extended attributes in inodes
+        | 0x2000  # metadata checksum seed
+        | 0x4000  # large directories
+    )
+    extents_flag = 0x80000
+    inline_data_flag = 0x10000000
+
+    def __init__(self, image: "BlockSource", offset: int = 0):
+        self.image = image
+        self.offset = offset
+        superblock = image.read(offset + 1024, 1024)
+        if len(superblock) < 1024 or struct.unpack_from("<H", superblock, 56)[0] != 0xef53:
+            raise ValueError("not an ext2/3/4 filesystem")
+        first_data_block, log_block_size = struct.unpack_from("<II", superblock, 20)
+        self.inodes_per_group, = struct.unpack_from("<I", superblock, 40)
+        revision, = struct.unpack_from("<I", superblock, 76)
+        self.inode_size = struct.unpack_from("<H", superblock, 88)[0] if revision else 128
+        incompat_features, = struct.unpack_from("<I", superblock, 96)
+        unsupported = incompat_features & ~self.supported_incompat_features
+        if unsupported:
+            raise ValueError(f"unsupported ext filesystem features: {unsupported:#x}")
+        self.block_size = 1024 << log_block_size
+        self.has_filetype = bool(incompat_features & 0x0002)
+        self.descriptor_size = 32
+        if incompat_features & 0x0080:
+            self.descriptor_size = struct.unpack_from("<H", superblock, 254)[0]
+        self.descriptor_table_block = first_data_block + 1
+
+    def extract(self, path: str, output_filename: str) -> None:
+        """Write the contents of a file to a sparse output file, following symlinks.
+
+        Will not overwrite an existing file."""
+        inode = self.lookup(path)
+        if not stat.S_ISREG(inode.mode):
+            raise ValueError(f"not a regular file: {path}")
+        with open(output_filename, "xb") as output:
+            output.truncate(inode.size)
+            for position, chunk in self.read_chunks(inode):
+                os.pwrite(output.fileno(), chunk, position)
+
+    def lookup(self, path: str, follow_symlinks: bool = True) -> ExtInode:
+        """Find the inode of a file by its absolute path."""
+        return self._lookup(path, follow_symlinks, 0)
+
+    def readlink(self, inode: ExtInode) -> str:
+        """Get the target of a symlink."""
+        if not stat.S_ISLNK(inode.mode):
+            raise ValueError(f"not a symlink: inode {inode.number}")
+        is_fast = not inode.flags & self.extents_flag and inode.size < 60 and not inode.data_blocks
+        if is_fast:
+            target = inode.block[:inode.size]
+        else:
+            target = b"".join(chunk for _, chunk in self.read_chunks(inode))
+        return target.decode("utf-8", "surrogateescape")
+
+    def read_chunks(
+            self,
+            inode: ExtInode,
+            max_chunk_size: int = 1024 * 1024,
+        ) -> Iterator[Tuple[int, bytes]]:
+        """Read the contents of a file as (position, data) chunks, skipping holes."""
+        if inode.flags & self.inline_data_flag:
+            raise ValueError(f"inline data is not supported: inode {inode.number}")
+        max_blocks = max(1, max_chunk_size // self.block_size)
+        for logical_block, physical_block, count in self._block_runs(inode):
+            while count > 0:
+                position = logical_block * self.block_size
+                if position >= inode.size:
+                    return
+                run = min(count, max_blocks)
+                length = min(run * self.block_size, inode.size - position)
+                yield position, self._read_blocks_at(physical_block * self.block_size, length)
+                logical_block += run
+                physical_block += run
+                count -= run
+
+    def read_inode(self, number: int) -> ExtInode:
+        """Read an inode by its number."""
+        group, index = divmod(number - 1, self.inodes_per_group)
+        descriptor = self._read_blocks_at(
+            self.descriptor_table_block * self.block_size + group * self.descriptor_size,
+            self.descriptor_size,
+        )
+        inode_table, = struct.unpack_from("<I", descriptor, 8)
+        if self.descriptor_size >= 64:
+            inode_table |= struct.unpack_from("<I", descriptor, 0x28)[0] << 32
+        raw = self._read_blocks_at(
+            inode_table * self.block_size + index * self.inode_size, min(self.inode_size, 160)
         )
-    return int(logical)
+        mode, size_lo = struct.unpack_from("<HxxI", raw, 0)
+        blocks, flags = struct.unpack_from("<II", raw, 28)
+        file_acl, size_hi = struct.unpack_from("<II", raw, 104)
+        data_blocks = blocks - (self.block_size // 512 if file_acl else 0)
+        return ExtInode(number, mode, size_lo | size_hi << 32, flags, data_blocks, raw[40:100])
+
+    def listdir(self, inode: ExtInode) -> Dict[str, int]:
+        """List directory entries, mapping names to inode numbers."""
+        if not stat.S_ISDIR(inode.mode):
+            raise ValueError(f"not a directory: inode {inode.number}")
+        entries = {}
+        data = b"".join(chunk for _, chunk in self.read_chunks(inode))
+        position = 0
+        while position + 8 <= len(data):
+            number, record_length, name_length = struct.unpack_from("<IHH", data, position)
+            if self.has_filetype:
+                name_length &= 0xff
+            if record_length < 8:
+                raise ValueError(f"corrupted directory: inode {inode.number}")
+            # unused entries, htree nodes and checksum tails have inode number 0
+            if number:
+                name = data[position + 8:position + 8 + name_length]
+                entries[name.decode("utf-8", "surrogateescape")] = number
+            position += record_length
+        return entries
+
+    def _lookup(self, path: str, follow_symlinks: bool, depth: int) -> ExtInode:
+        if depth > 40:
+            raise ValueError(f"too many levels of symbolic links: {path}")
+        inode = self.read_inode(2)
+        parts = [part for part in path.split("/") if part]
+        for index, part in enumerate(parts):
+            number = self.listdir(inode).get(part)
+            if number is None:
+                raise ValueError(f"file not found: {path}")
+            inode = self.read_inode(number)
+            is_last = index == len(parts) - 1
+            if stat.S_ISLNK(inode.mode) and (follow_symlinks or not is_last):
+                target = self.readlink(inode)
+                if not target.startswith("/"):
+                    target = "/" + "/".join(parts[:index] + [target])
+                target = "/".join([target] + parts[index + 1:])
+                return self._lookup(target, follow_symlinks, depth + 1)
+        return inode
+
+    def _block_runs(self, inode: ExtInode) -> Iterator[Tuple[int, int, int]]:
+        """List (logical block, physical block, block count) runs of allocated blocks."""
+        if inode.flags & self.extents_flag:
+            yield from self._extent_runs(inode.block)
+        else:
+            yield from self._block_map_runs(inode.block)
+
+    def _extent_runs(self, node: bytes) -> Iterator[Tuple[int, int, int]]:
+        magic, entries, _, depth = struct.unpack_from("<HHHH", node, 0)
+        if magic != 0xf30a:
+            raise ValueError("corrupted extent tree")
+        for index in range(entries):
+            entry_offset = 12 + index * 12
+            if depth == 0:
+                logical_block, length, start_hi, start_lo = struct.unpack_from(
+                    "<IHHI", node, entry_offset
+                )
+                # uninitialized extents read as zeros, like holes
+                if length <= 32768:
+                    yield logical_block, start_hi << 32 | start_lo, length
+            else:
+                _, leaf_lo, leaf_hi = struct.unpack_from("<IIH", node, entry_offset)
+                leaf = leaf_hi << 32 | leaf_lo
+                yield from self._extent_runs(
+                    self._read_blocks_at(leaf * self.block_size, self.block_size)
+                )
+
+    def _block_map_runs(self, block: bytes) -> Iterator[Tuple[int, int, int]]:
+        pointers_per_block = self.block_size // 4
+        pointers = struct.unpack("<15I", block)
+        logical_block = 0
+        runs = []
+        for index, pointer in enumerate(pointers):
+            level = max(0, index - 11)
+            span = pointers_per_block ** level
+            if pointer:
+                runs.extend(self._indirect_runs(pointer, level, logical_block))
+            logical_block += span
+        yield from self._merge_runs(runs)
+
+    def _indirect_runs(
+            self,
+            pointer: int,
+            level: int,
+            logical_block: int,
+        ) -> List[Tuple[int, int, int]]:
+        if level == 0:
+            return [(logical_block, pointer, 1)]
+        pointers_per_block = self.block_size // 4
+        indirect_block = self._read_blocks_at(pointer * self.block_size, self.block_size)
+        table = struct.unpack(f"<{pointers_per_block}I", indirect_block)
+        span = pointers_per_block ** (level - 1)
+        runs = []
+        for index, child in enumerate(table):
+            if child:
+                runs.extend(self._indirect_runs(child, level - 1, logical_block + index * span))
+        return runs
+
+    @staticmethod
+    def _merge_runs(runs: Iterable[Tuple[int, int, int]]) -> Iterator[Tuple[int, int, int]]:
+        current = None
+        for logical_block, physical_block, count in runs:
+            if current and (current[0] + current[2], current[1] + current[2]) == (
+                    logical_block, physical_block):
+                current = (current[0], current[1], current[2] + count)
+                continue
+            if current:
+                yield current
+            current = (logical_block, physical_block, count)
+        if current:
+            yield current
+
+    def _read_blocks_at(self, position: int, length: int) -> bytes:
+        data = self.image.read(self.offset + position, length)
+        if len(data) < length:
+            raise ValueError(f"unexpected end of filesystem at offset: {position}")
+        return data
 
 
 def extract_partition_boot_files(
@@ -325,28 +1932,115 @@ def extract_partition_boot_files(
         raise ValueError(f"already exists: {output_kernel_filename}")
     if os.path.exists(output_initrd_filename):
         raise ValueError(f"already exists: {output_initrd_filename}")
-    kernel = parse_symlink_target(debugfs_command(partition_filename, "stat /vmlinuz"))
-    initrd = parse_symlink_target(debugfs_command(partition_filename, "stat /initrd.img"))
-    debugfs_command(partition_filename, f"dump {kernel} {output_kernel_filename}")
-    debugfs_command(partition_filename, f"dump {initrd} {output_initrd_filename}")
+    with DebugfsSession(partition_filename) as session:
+        kernel_stat, initrd_stat = session.run_many(["stat /vmlinuz", "stat /initrd.img"])
+        kernel = parse_symlink_target(kernel_stat)
+        initrd = parse_symlink_target(initrd_stat)
+        session.run_many([
+            f"dump {kernel} {output_kernel_filename}",
+            f"dump {initrd} {output_initrd_filename}",
+        ])
 
 
-def debugfs_command(partition_filename: str, command: str) -> str:
-    """Run a debugfs command."""
-    if not os.path.exists(partition_filename):
-        raise ValueError(f"file not found: {partition_filename}")
-    cmd = ["/sbin/debugfs", "-w", "-f", "-", partition_filename]
-    process = subprocess.Popen(
-        cmd,
-        universal_newlines=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout, stderr = process.communicate(command)
-    if process.returncode != 0:
-        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
-    return stdout
+def debugfs_command(partition_filename: str, command: str, offset: int = 0) -> str:
+    """Run debugfs commands, one per line, with write access.
+
+    The filesystem can start at an offset in bytes, e.g. within a disk image."""
+    with DebugfsSession(partition_filename, offset, writable=True) as session:
+        return "".join(session.run_many(command.splitlines()))
+
+
+class DebugfsSession:
+    """A debugfs process which runs commands until closed.
+
+    Commands are pipelined and the output of each is separated with a
+    comment line, which debugfs echoes back. The filesystem is opened
+    read-only, unless writable is set. It can start at an offset in bytes,
+    e.g. within a disk image."""
+
+    def __init__(self, partition_filename: str, offset: int = 0, writable: bool = False):
+        if not os.path.exists(partition_filename):
+            raise ValueError(f"file not found: {partition_filename}")
+        device = f"{partition_filename}?offset={offset}" if offset else partition_filename
+        self._cmd = ["/sbin/debugfs"] + (["-w"] if writable else []) + ["-f", "-", device]
+        # pylint: disable=consider-using-with
+        self._process = subprocess.Popen(
+            self._cmd,
+            universal_newlines=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # collect errors in the background, so that a full pipe can't block debugfs
+        self._stderr: List[str] = []
+        self._stderr_thread = threading.Thread(
+            target=lambda: self._stderr.extend(self._process.stderr),  # type: ignore
+            daemon=True,
+        )
+        self._stderr_thread.start()
+        self._marker = 0
+
+    def __enter__(self) -> "DebugfsSession":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def run(self, command: str) -> str:
+        """Run a single command and return its output."""
+        return self.run_many([command])[0]
+
+    def run_many(self, commands: Iterable[str]) -> List[str]:
+        """Send several commands at once and return the output of each."""
+        assert self._process.stdin is not None and self._process.stdout is not None
+        markers = []
+        lines = []
+        for command in commands:
+            if "\n" in command:
+                raise ValueError(f"invalid debugfs command: {command!r}")
+            self._marker += 1
+            marker = f"# preseed_install {self._marker}\n"
+            markers.append((command, marker))
+            lines.append(f"{command}\n{marker}")
+        try:
+            self._process.stdin.write("".join(lines))
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            self.close()
+            raise ValueError("debugfs exited unexpectedly") from None
+        outputs = []
+        for command, marker in markers:
+            output = []
+            for line in self._process.stdout:
+                if line == marker:
+                    break
+                output.append(line)
+            else:
+                self.close()
+                raise ValueError("debugfs exited unexpectedly")
+            # drop the echoed command
+            if output and output[0] == f"debugfs: {command}\n":
+                del output[0]
+            outputs.append("".join(output))
+        return outputs
+
+    def close(self) -> None:
+        """Wait for debugfs to finish all commands and exit."""
+        assert self._process.stdin is not None and self._process.stdout is not None
+        if self._process.returncode is not None:
+            return
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        stdout = self._process.stdout.read()
+        self._process.stdout.close()
+        returncode = self._process.wait()
+        self._stderr_thread.join()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, self._cmd, stdout, "".join(self._stderr),
+            )
 
 
 def parse_symlink_target(debugfs_output: str) -> str:
@@ -361,9 +2055,101 @@ def parse_symlink_target(debugfs_output: str) -> str:
     return split_to_unquote[0]
 
 
-def iso_is_arm(iso_filename: str) -> bool:
+def iso_is_arm(iso: IsoInfo) -> bool:
     """Does the installation ISO image correspond to an ARM architecture?"""
-    return get_debian_architecture(iso_filename) in ("arm64", "armel", "armhf")
+    return iso.architecture in ("arm64", "armel", "armhf")
+
+
+def data_ranges(fd: int, start: int, end: int) -> Iterator[Tuple[int, int]]:
+    """List (start, end) byte ranges of a file within a range which may contain data.
+
+    Uses SEEK_DATA and SEEK_HOLE, so holes are skipped where the platform and
+    the filesystem support it. Anything outside the listed ranges reads as
+    zeros."""
+    if not hasattr(os, "SEEK_DATA"):
+        yield start, end
+        return
+    position = start
+    while position < end:
+        try:
+            data_start = os.lseek(fd, position, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                # no more data until the end of the file
+                return
+            yield position, end
+            return
+        if data_start >= end:
+            return
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), end)
+        yield data_start, data_end
+        position = data_end
+
+
+def sparse_copy(
+        src_fd: int,
+        dst_fd: int,
+        src_offset: int,
+        count: int,
+        dst_offset: int,
+    ) -> CopyStats:
+    """Copy a byte range between two file descriptors, skipping holes in the source.
+
+    Only the data ranges are copied, with copy_range. The skipped ranges of
+    the destination are not written, so they should already read as zeros,
+    e.g. in a new file. The destination is extended to the end of the range
+    if needed."""
+    copied = 0
+    for start, end in data_ranges(src_fd, src_offset, src_offset + count):
+        copy_range(src_fd, dst_fd, start, end - start, start - src_offset + dst_offset)
+        copied += end - start
+    if os.fstat(dst_fd).st_size < dst_offset + count:
+        os.ftruncate(dst_fd, dst_offset + count)
+    return CopyStats(copied, count - copied)
+
+
+def copy_range(src_fd: int, dst_fd: int, src_offset: int, count: int, dst_offset: int) -> None:
+    """Copy a byte range between two file descriptors.
+
+    Uses copy_file_range or sendfile, so that the data is moved by the kernel
+    without passing through user space, where the platform and the
+    filesystems support it, and falls back to a buffered copy otherwise."""
+    copied = 0
+    # added in Python 3.8
+    os_copy_file_range: Any = getattr(os, "copy_file_range", None)
+
+    def kernel_copy_file_range(length: int) -> int:
+        return int(os_copy_file_range(
+            src_fd, dst_fd, length, src_offset + copied, dst_offset + copied
+        ))
+
+    def kernel_sendfile(length: int) -> int:
+        os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+        return os.sendfile(dst_fd, src_fd, src_offset + copied, length)
+
+    def buffered(length: int) -> int:
+        chunk = os.pread(src_fd, min(length, 1024 * 1024), src_offset + copied)
+        return os.pwrite(dst_fd, chunk, dst_offset + copied)
+
+    methods = [buffered]
+    if sys.platform.startswith("linux"):
+        methods.insert(0, kernel_sendfile)
+    if os_copy_file_range is not None:
+        methods.insert(0, kernel_copy_file_range)
+    unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+    for method in methods:
+        try:
+            while copied < count:
+                length = method(count - copied)
+                if not length:
+                    break
+                copied += length
+        except OSError as error:
+            if method is buffered or error.errno not in unsupported:
+                raise
+        if copied == count:
+            return
+    raise ValueError(f"unexpected end of file at offset: {src_offset + copied}")
 
 
 def named_tmp(content: bytes) -> IO:
@@ -374,19 +2160,801 @@ def named_tmp(content: bytes) -> IO:
     return tmp_file
 
 
+class FileCache:
+    """A directory of cached files with a size budget and LRU eviction.
+
+    Recently used files are the ones with the most recent modification
+    time, which is updated on every cache hit. Hits and misses are counted
+    in a hidden JSON file kept in the same directory."""
+
+    stats_filename = ".stats.json"
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        """Get the path of a cache entry, whether it exists or not."""
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """Get the path of a cached file, or None if it's not in the cache."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return path
+
+    def put(self, key: str, write: Callable[[IO], None]) -> str:
+        """Add a file to the cache, with contents written by a callback.
+
+        Evicts least recently used files if the cache size exceeds the
+        budget. The newly added file is never evicted."""
+        with tempfile.NamedTemporaryFile(dir=self.directory, prefix=".tmp.", delete=False) as tmp:
+            try:
+                write(tmp)
+            except BaseException:
+                os.unlink(tmp.name)
+                raise
+        return self.add(key, tmp.name)
+
+    def add(self, key: str, filename: str) -> str:
+        """Move an existing file into the cache.
+
+        The file should be on the same filesystem as the cache, e.g. a
+        hidden temporary file in the cache directory. Evicts least recently
+        used files like put."""
+        os.replace(filename, self.path(key))
+        self.evict(keep=key)
+        return self.path(key)
+
+    def open(self, key: str) -> IO:
+        """Open a cached file through a private hardlink.
+
+        The hardlink has the same name as the entry and is kept in a hidden
+        temporary directory, so that other processes (like QEMU) can still
+        open the file by name after the entry is evicted. The directory is
+        removed once the returned file is garbage collected."""
+        directory = tempfile.mkdtemp(dir=self.directory, prefix=".tmp.")
+        try:
+            path = os.path.join(directory, key)
+            os.link(self.path(key), path)
+            file = open(path, "rb")  # pylint: disable=consider-using-with
+        except BaseException:
+            shutil.rmtree(directory)
+            raise
+        weakref.finalize(file, shutil.rmtree, directory, ignore_errors=True)
+        return file
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Remove least recently used files until the cache fits in its budget."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith("."):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.name))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path(name))
+            total_size -= size
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of entries, total size, and hit and miss counts."""
+        sizes = [
+            entry.stat().st_size for entry in os.scandir(self.directory)
+            if not entry.name.startswith(".")
+        ]
+        with locked_json(os.path.join(self.directory, self.stats_filename)) as counts:
+            return {
+                "entries": len(sizes),
+                "size": sum(sizes),
+                "hits": counts.get("hits", 0),
+                "misses": counts.get("misses", 0),
+            }
+
+    def _count(self, counter: str) -> None:
+        with locked_json(os.path.join(self.directory, self.stats_filename)) as counts:
+            counts[counter] = counts.get(counter, 0) + 1
+
+
+class ContentStore:
+    """A directory of files named by the SHA-256 digests of their contents.
+
+    Files with identical contents are hardlinked to (or reflinked from) a
+    single stored file, which is made read-only, because hardlinks share
+    it. The link count of a stored file is its reference count; files which
+    are no longer linked from anywhere else are removed by garbage
+    collection."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        """Get the path of a stored file, whether it exists or not."""
+        return os.path.join(self.directory, digest)
+
+    def link(self, filename: str, target_filename: str) -> None:
+        """Move a file to a target path, sharing the stored copy of its contents.
+
+        The file is added to the store if it's not there yet. Falls back to
+        a plain move if the target can't be linked to the store, e.g. when
+        they're on different filesystems."""
+        path = self.path(file_digest(filename))
+        os.chmod(filename, 0o444)
+        try:
+            os.link(filename, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            os.replace(filename, target_filename)
+            return
+        try:
+            link_or_reflink(path, target_filename)
+        except (ValueError, FileNotFoundError):
+            # not linkable, or removed by a concurrent garbage collection
+            os.replace(filename, target_filename)
+            return
+        os.unlink(filename)
+
+    def gc(self) -> Tuple[int, int]:
+        """Remove stored files which aren't linked from anywhere else.
+
+        Returns the number of removed files and their total size."""
+        removed = 0
+        freed = 0
+        for entry in os.scandir(self.directory):
+            try:
+                stat_result = entry.stat()
+            except FileNotFoundError:
+                continue
+            if stat_result.st_nlink == 1:
+                os.unlink(entry.path)
+                removed += 1
+                freed += stat_result.st_size
+        return removed, freed
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number of stored files, their total size and the number of links."""
+        stat_results = [entry.stat() for entry in os.scandir(self.directory)]
+        return {
+            "entries": len(stat_results),
+            "size": sum(stat_result.st_size for stat_result in stat_results),
+            "links": sum(stat_result.st_nlink - 1 for stat_result in stat_results),
+        }
+
+
+class AptProxy:
+    """A caching HTTP proxy for package downloads, running in a background thread.
+
+    Meant to be used by the Debian installer and APT in a guest, which
+    reaches it through the user mode network's host address. Package files
+    (.deb and .udeb) don't change once published, so they are cached under
+    their SHA-256 digests, with an index mapping their pool paths to the
+    digests, so that all mirrors share the cached files. Everything else,
+    like repository indexes, is passed through. Each connection serves one
+    request and upstream requests use HTTP/1.0, which avoids persistent
+    connections and chunked transfers.
+
+    install() passes the proxy to the installer as a kernel parameter,
+    which preseed files shouldn't override. The installer keeps the setting
+    in /etc/apt/apt.conf of the installed system, where it should be
+    removed, e.g. with preseed/late_command."""
+
+    cacheable_suffixes = (".deb", ".udeb")
+    index_filename = ".index.json"
+
+    def __init__(self, cache_directory: str, max_size: int, host: str = "127.0.0.1"):
+        self.cache = FileCache(cache_directory, max_size)
+        self._loop = asyncio.new_event_loop()
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, host, 0))
+        self.port: int = self._server.sockets[0].getsockname()[1]
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def __enter__(self) -> "AptProxy":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop the proxy, aborting requests in progress."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.run_until_complete(self._shutdown())
+        self._loop.close()
+
+    async def _shutdown(self) -> None:
+        self._server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await self._serve(reader, writer)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as error:
+            logger.info("APT proxy: %s", error)
+        finally:
+            writer.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        await read_http_headers(reader)
+        try:
+            method, url, _ = request_line.split(" ")
+        except ValueError:
+            raise ValueError(f"invalid request: {request_line!r}") from None
+        parts = urllib.parse.urlsplit(url)
+        if method not in ("GET", "HEAD") or parts.scheme != "http" or not parts.hostname:
+            await send_http_error(writer, "501 Not Implemented")
+            return
+        key = self._cache_key(parts)
+        if key is not None:
+            loop = asyncio.get_running_loop()
+            # locking the index and the cache statistics blocks
+            path = await loop.run_in_executor(None, self._cached_path, key)
+            cached_file = None
+            if path is not None:
+                try:
+                    cached_file = open(path, "rb")  # pylint: disable=consider-using-with
+                except FileNotFoundError:
+                    # evicted in the meantime
+                    pass
+            if cached_file is not None:
+                with cached_file:
+                    await self._send_cached(writer, method, cached_file)
+                return
+        await self._forward(writer, method, parts, key)
+
+    def _cache_key(self, parts: urllib.parse.SplitResult) -> Optional[str]:
+        if not parts.path.endswith(self.cacheable_suffixes) or parts.query:
+            return None
+        pool_index = parts.path.find("/pool/")
+        if pool_index >= 0:
+            return parts.path[pool_index + 1:]
+        return parts.netloc + parts.path
+
+    def _cached_path(self, key: str) -> Optional[str]:
+        with locked_json(os.path.join(self.cache.directory, self.index_filename)) as index:
+            digest = index.get(key)
+        return self.cache.get(digest) if digest else None
+
+    def _store(self, key: str, digest: str, filename: str) -> None:
+        self.cache.add(digest, filename)
+        with locked_json(os.path.join(self.cache.directory, self.index_filename)) as index:
+            index[key] = digest
+
+    @staticmethod
+    async def _send_cached(writer: asyncio.StreamWriter, method: str, cached_file: IO) -> None:
+        size = os.fstat(cached_file.fileno()).st_size
+        writer.write((
+            "HTTP/1.1 200 OK\r\n"
+            f"Content-Length: {size}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1"))
+        while method == "GET":
+            chunk = cached_file.read(64 * 1024)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+        await writer.drain()
+
+    async def _forward(
+            self,
+            writer: asyncio.StreamWriter,
+            method: str,
+            parts: urllib.parse.SplitResult,
+            key: Optional[str],
+        ) -> None:
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(
+                parts.hostname, parts.port or 80
+            )
+        except OSError as error:
+            await send_http_error(writer, "502 Bad Gateway")
+            raise ValueError(f"can't connect to {parts.netloc}: {error}") from None
+        try:
+            target = parts.path or "/"
+            if parts.query:
+                target += "?" + parts.query
+            upstream_writer.write((
+                f"{method} {target} HTTP/1.0\r\n"
+                f"Host: {parts.netloc}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1"))
+            status_line = await upstream_reader.readline()
+            headers = await read_http_headers(upstream_reader)
+            hop_by_hop = ("connection", "keep-alive", "transfer-encoding", "proxy-connection")
+            writer.write(status_line + b"".join(
+                f"{name}: {value}\r\n".encode("latin-1")
+                for name, value in headers if name.lower() not in hop_by_hop
+            ) + b"Connection: close\r\n\r\n")
+            status = status_line.split(b" ", 2)[1:2]
+            if key is None or method != "GET" or status != [b"200"]:
+                key = None
+            await self._relay(upstream_reader, writer, key, headers)
+        finally:
+            upstream_writer.close()
+
+    async def _relay(
+            self,
+            upstream_reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            key: Optional[str],
+            headers: List[Tuple[str, str]],
+        ) -> None:
+        # pylint: disable=consider-using-with
+        tmp = None
+        if key is not None:
+            tmp = tempfile.NamedTemporaryFile(
+                dir=self.cache.directory, prefix=".tmp.", delete=False
+            )
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            while True:
+                chunk = await upstream_reader.read(64 * 1024)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                if tmp is not None:
+                    tmp.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                await writer.drain()
+            if tmp is None or key is None:
+                return
+            tmp.close()
+            lengths = [value for name, value in headers if name.lower() == "content-length"]
+            if lengths and lengths[0].strip() != str(size):
+                raise ValueError(f"incomplete download of {key}")
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._store, key, digest.hexdigest(), tmp.name
+            )
+        finally:
+            if tmp is not None:
+                tmp.close()
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(tmp.name)
+
+
+async def read_http_headers(reader: asyncio.StreamReader) -> List[Tuple[str, str]]:
+    """Read HTTP header fields, up to and including the empty line which ends them."""
+    headers: List[Tuple[str, str]] = []
+    while True:
+        line = (await reader.readline()).decode("latin-1")
+        if not line.strip():
+            return headers
+        name, _, value = line.partition(":")
+        headers.append((name.strip(), value.strip()))
+
+
+async def send_http_error(writer: asyncio.StreamWriter, status: str) -> None:
+    """Send an HTTP error response without a body."""
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode("latin-1")
+    )
+    await writer.drain()
+
+
+def verify_iso(iso_filename: str, sums_filename: str, cache: Optional[CacheConfig]) -> None:
+    """Verify an ISO image against a SHA256SUMS file.
+
+    The image is looked up by its filename. Images renamed after download
+    are accepted as long as their digest is listed."""
+    with open(sums_filename, "r", encoding="utf-8") as sums_file:
+        sums = parse_sha256sums(sums_file.read())
+    digest = cached_file_digest(iso_filename, cache)
+    listed_digest = sums.get(os.path.basename(iso_filename))
+    if listed_digest is not None and listed_digest != digest:
+        raise ValueError(f"SHA-256 digest mismatch: {iso_filename}")
+    if listed_digest is None and digest not in sums.values():
+        raise ValueError(f"not listed in {sums_filename}: {iso_filename}")
+
+
+def parse_sha256sums(sums: str) -> Dict[str, str]:
+    """Parse the contents of a SHA256SUMS file into a filename to digest mapping."""
+    parsed = {}
+    for line in sums.splitlines():
+        if not line.strip():
+            continue
+        match = re.fullmatch(r"([0-9a-fA-F]{64}) [ *](.+)", line.strip())
+        if not match:
+            raise ValueError(f"unable to parse SHA256SUMS line: {line}")
+        parsed[os.path.basename(match.group(2))] = match.group(1).lower()
+    return parsed
+
+
+def cached_file_digest(filename: str, cache: Optional[CacheConfig]) -> str:
+    """Get the SHA-256 digest of a file, computing it only if the file has changed.
+
+    Digests are stored in an extended attribute of the file and, with a cache
+    configured, in an index keyed by the file's real path. Both are guarded
+    by the file's stat fingerprint. The index covers files on filesystems
+    without extended attribute support or without write permission."""
+    path = os.path.realpath(filename)
+    fingerprint = file_fingerprint(path)
+    index_filename = os.path.join(cache.directory, "digests.json") if cache else None
+    with contextlib.suppress(OSError, ValueError, KeyError, AttributeError):
+        stored = json.loads(os.getxattr(path, DIGEST_XATTR))
+        if stored["fingerprint"] == fingerprint:
+            return str(stored["sha256"])
+    if index_filename:
+        with locked_json(index_filename) as index:
+            if path in index and index[path]["fingerprint"] == fingerprint:
+                return str(index[path]["sha256"])
+    digest = file_digest(path)
+    stored = {"fingerprint": fingerprint, "sha256": digest}
+    with contextlib.suppress(OSError, AttributeError):
+        os.setxattr(path, DIGEST_XATTR, json.dumps(stored).encode())
+    if index_filename:
+        with locked_json(index_filename) as index:
+            index[path] = stored
+    return digest
+
+
+def file_fingerprint(filename: str) -> str:
+    """Get a string that changes whenever the file is replaced or modified."""
+    stat = os.stat(filename)
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def file_digest(filename: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    """Calculate the SHA-256 digest of a file.
+
+    The file is read in large chunks by a background thread, so that reading
+    the next chunk overlaps with hashing the previous one (hashlib releases
+    the GIL while hashing large buffers)."""
+    digest = hashlib.sha256()
+    chunks: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=4)
+    errors: List[OSError] = []
+
+    def read() -> None:
+        try:
+            with open(filename, "rb", buffering=0) as file:
+                with contextlib.suppress(AttributeError, OSError):
+                    os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while True:
+                    chunk = file.read(chunk_size)
+                    if not chunk:
+                        break
+                    chunks.put(chunk)
+        except OSError as error:
+            errors.append(error)
+        finally:
+            chunks.put(None)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            break
+        digest.update(chunk)
+    reader.join()
+    if errors:
+        raise errors[0]
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def locked_json(filename: str) -> Iterator[Dict[str, Any]]:
+    """Load a JSON object from a file under an exclusive lock and save it back.
+
+    The lock is held on a separate file, so that the data file can be
+    replaced atomically. A missing or corrupted file reads as empty."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename + ".lock", "a", encoding="utf-8") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(filename, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            data = {}
+        yield data
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf-8", dir=os.path.dirname(filename), prefix=".tmp.", delete=False
+        ) as tmp:
+            json.dump(data, tmp)
+        os.replace(tmp.name, filename)
+
+
+def default_cache_dir() -> str:
+    """Get the default cache directory, following the XDG base directory spec."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "preseed_install")
+
+
+def parse_size(size: str) -> int:
+    """Parse a size in bytes with an optional binary unit suffix, e.g. 512M or 2G."""
+    match = re.fullmatch(r"([0-9]+)([KMGT]?)", size.strip().upper())
+    if not match:
+        raise ValueError(f"invalid size: {size}")
+    return int(match.group(1)) * int(1024 ** " KMGT".index(match.group(2) or " "))
+
+
+def parse_auto(parse: Callable[[str], int]) -> Callable[[str], Union[int, str]]:
+    """Make a parser for values which can also be "auto"."""
+
+    def parse_value(value: str) -> Union[int, str]:
+        if value == "auto":
+            return value
+        parsed = parse(value)
+        if parsed <= 0:
+            raise ValueError(f"not positive: {value}")
+        return parsed
+
+    parse_value.__name__ = parse.__name__
+    return parse_value
+
+
+def print_cache_stats(cache: CacheConfig) -> None:
+    """Print statistics of all file caches in a cache directory."""
+    if not os.path.isdir(cache.directory):
+        return
+    for entry in sorted(os.scandir(cache.directory), key=lambda entry: entry.name):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        if entry.name == "store":
+            stats = ContentStore(entry.path).stats()
+        else:
+            stats = FileCache(entry.path, cache.max_size).stats()
+        print(f"{entry.name}: " + " ".join(f"{name}={value}" for name, value in stats.items()))
+
+
+def cache_main(argv: List[str]) -> None:
+    """CLI for managing the cache."""
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} cache")
+    parser.add_argument(
+        "command",
+        choices=["stats", "gc"],
+        help="cache command: print statistics, or remove stored boot files of deleted images",
+    )
+    add_cache_arguments(parser)
+    args = parser.parse_args(argv)
+    cache = CacheConfig(args.cache_dir, parse_size(args.cache_size))
+    if args.command == "stats":
+        print_cache_stats(cache)
+    elif args.command == "gc":
+        store_directory = os.path.join(cache.directory, "store")
+        if os.path.isdir(store_directory):
+            removed, freed = ContentStore(store_directory).gc()
+            print(f"removed {removed} files, {freed} bytes")
+
+
+def library_index(
+        directories: Iterable[str],
+        cache: CacheConfig,
+        warm: bool = False,
+        jobs: Optional[int] = None,
+    ) -> List[LibraryEntry]:
+    """Index the ISO images found in directories into the library.
+
+    Images are processed in parallel. Metadata of images which haven't
+    changed since they were last indexed is reused. Warming extracts the
+    installer boot files of all images into the boot file cache. Images
+    which aren't Debian installation images are skipped."""
+    index_filename = os.path.join(cache.directory, "library.json")
+    filenames = sorted(
+        os.path.realpath(os.path.join(dirpath, name))
+        for directory in directories
+        for dirpath, _, names in os.walk(directory)
+        for name in names
+        if name.lower().endswith(".iso")
+    )
+    with locked_json(index_filename) as index:
+        indexed = dict(index)
+
+    def index_image(filename: str) -> Optional[Tuple[LibraryEntry, str]]:
+        try:
+            fingerprint = file_fingerprint(filename)
+            if filename in indexed and indexed[filename]["fingerprint"] == fingerprint:
+                entry = LibraryEntry(**indexed[filename]["entry"])
+            else:
+                iso = IsoInfo(filename)
+                entry = LibraryEntry(
+                    filename,
+                    iso.version,
+                    iso.architecture,
+                    *iso_get_boot_filenames(iso, cache),
+                    cached_file_digest(filename, cache),
+                    os.stat(filename).st_size,
+                )
+            if warm:
+                boot_filenames = [entry.kernel, entry.initrd]
+                for boot_file in iso_extract_files_cached(filename, boot_filenames, cache):
+                    boot_file.close()
+        except (OSError, ValueError) as error:
+            print(f"skipping {filename}: {error}", file=sys.stderr)
+            return None
+        return entry, fingerprint
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = [result for result in executor.map(index_image, filenames) if result]
+    with locked_json(index_filename) as index:
+        for filename in list(index):
+            if not os.path.exists(filename):
+                del index[filename]
+        for entry, fingerprint in results:
+            index[entry.filename] = {"fingerprint": fingerprint, "entry": entry._asdict()}
+    return [entry for entry, _ in results]
+
+
+def library_find(
+        cache: CacheConfig,
+        version: Optional[int] = None,
+        architecture: Optional[str] = None,
+    ) -> List[LibraryEntry]:
+    """Find indexed ISO images by Debian version and architecture."""
+    with locked_json(os.path.join(cache.directory, "library.json")) as index:
+        entries = [LibraryEntry(**indexed["entry"]) for indexed in index.values()]
+    return sorted(
+        (
+            entry for entry in entries
+            if version in (None, entry.version) and architecture in (None, entry.architecture)
+        ),
+        key=lambda entry: entry.filename,
+    )
+
+
+def library_main(argv: List[str]) -> None:
+    """CLI for managing the local ISO image library."""
+    parser = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} library")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in [
+            ("index", "index ISO images in directories"),
+            ("warm", "index ISO images and extract their boot files into the cache"),
+        ]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("directories", nargs="+", metavar="DIR", help="ISO directory")
+        subparser.add_argument("-j", dest="jobs", type=int, help="number of parallel jobs")
+        add_cache_arguments(subparser)
+    find_parser = subparsers.add_parser("find", help="find indexed ISO images")
+    find_parser.add_argument("-v", dest="version", type=int, help="Debian version")
+    find_parser.add_argument("-a", dest="architecture", help="Debian architecture")
+    add_cache_arguments(find_parser)
+    args = parser.parse_args(argv)
+    cache = CacheConfig(args.cache_dir, parse_size(args.cache_size))
+    if args.command == "find":
+        entries = library_find(cache, args.version, args.architecture)
+    else:
+        entries = library_index(args.directories, cache, args.command == "warm", args.jobs)
+    for entry in entries:
+        print(f"{entry.filename}\t{entry.version}\t{entry.architecture}")
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add cache configuration options to a CLI parser."""
+    parser.add_argument(
+        "--cache-dir", dest="cache_dir", help="cache directory", default=default_cache_dir()
+    )
+    parser.add_argument(
+        "--cache-size", dest="cache_size", help="size budget of each cache", default="2G"
+    )
+
+
 def main() -> None:
     """Simple CLI for the module."""
-    parser = argparse.ArgumentParser()
+    commands = {"cache": cache_main, "library": library_main}
+    if sys.argv[1:2] and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+    parser = argparse.ArgumentParser(
+        epilog=(
+            f"Run {os.path.basename(sys.argv[0])} cache --help for cache management"
+            f" and {os.path.basename(sys.argv[0])} library --help for the ISO image library."
+        ),
+    )
     parser.add_argument("-i", dest="iso_filename", required=True, help="ISO filename")
-    parser.add_argument("-u", dest="preseed_url", required=True, help="preseed URL")
+    preseed_group = parser.add_mutually_exclusive_group(required=True)
+    preseed_group.add_argument("-u", dest="preseed_url", help="preseed URL")
+    preseed_group.add_argument(
+        "-p", dest="preseed_filename", help="preseed file to add to the installer initrd"
+    )
     parser.add_argument("-o", dest="output_filename", required=True, help="output filename")
     parser.add_argument("-d", dest="vnc_display", help="VNC display")
     parser.add_argument("-s", dest="image_size", help="output image size", default="10G")
+    parser.add_argument(
+        "--installer-hd",
+        dest="installer_hd_mode",
+        choices=["image", "vvfat"],
+        default="image",
+        help="how to provide the ISO to hd-media installers: copied into a disk image"
+        " or exposed as a virtual FAT disk",
+    )
+    parser.add_argument(
+        "--x86-devices",
+        dest="x86_devices",
+        choices=["virtio", "legacy"],
+        default="virtio",
+        help="disk and network devices for amd64 and i386 installs: virtio, or IDE and e1000"
+        " for installers without virtio drivers",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=parse_auto(int),
+        default="auto",
+        help="number of vCPUs, or auto to share the host CPUs with running installs",
+    )
+    parser.add_argument(
+        "--memory",
+        type=parse_auto(parse_size),
+        default="auto",
+        help="guest memory size, e.g. 2G, or auto to share the available memory with running"
+        " installs",
+    )
+    parser.add_argument(
+        "--disk-io",
+        dest="disk_io",
+        choices=["install", "default"],
+        default="install",
+        help="target disk I/O profile: ignore guest flushes and flush once after the install,"
+        " or QEMU defaults",
+    )
+    parser.add_argument(
+        "--accel",
+        default="auto",
+        help="QEMU accelerator, e.g. kvm or tcg, or auto to use KVM where possible",
+    )
+    parser.add_argument(
+        "--apt-proxy",
+        dest="apt_proxy",
+        action="store_true",
+        help="cache packages downloaded by the installer with a built-in HTTP proxy",
+    )
+    parser.add_argument(
+        "--sha256sums", dest="sums_filename", help="verify the ISO image against a SHA256SUMS file"
+    )
+    add_cache_arguments(parser)
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="disable caching")
+    parser.add_argument("-v", dest="verbose", action="store_true", help="verbose output")
     args = parser.parse_args()
+    if args.apt_proxy and args.no_cache:
+        parser.error("--apt-proxy requires caching")
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s"
+    )
+    cache = None if args.no_cache else CacheConfig(args.cache_dir, parse_size(args.cache_size))
+    iso = IsoInfo(args.iso_filename)
+    if args.sums_filename:
+        verify_iso(args.iso_filename, args.sums_filename, cache)
     create_image(args.output_filename, args.image_size)
-    install(args.iso_filename, args.preseed_url, args.output_filename, args.vnc_display)
-    if iso_is_arm(args.iso_filename):
-        extract_boot_files(args.output_filename)
+    install(
+        iso,
+        args.preseed_url,
+        args.output_filename,
+        args.vnc_display,
+        cache,
+        args.preseed_filename,
+        args.installer_hd_mode,
+        args.x86_devices,
+        args.cpus,
+        args.memory,
+        args.disk_io,
+        args.accel,
+        args.apt_proxy,
+    )
+    if iso_is_arm(iso):
+        extract_boot_files(args.output_filename, cache)
 
 
 if __name__ == "__main__":
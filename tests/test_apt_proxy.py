@@ -0,0 +1,59 @@
+# pylint: disable=missing-docstring
+import functools
+import http.client
+import http.server
+import os
+import threading
+from typing import Iterator, Tuple
+import pytest
+from preseed_install import AptProxy
+
+PACKAGE_PATH = "/debian/pool/main/f/foo/foo_1.0_all.deb"
+PACKAGE = b"!<arch>\n" + bytes(range(256)) * 1000
+
+
+@pytest.fixture(name="mirror")
+def fixture_mirror(tmp_path: str) -> Iterator[http.server.HTTPServer]:
+    root = os.path.join(str(tmp_path), "mirror")
+    os.makedirs(os.path.join(root, os.path.dirname(PACKAGE_PATH[1:])))
+    with open(os.path.join(root, PACKAGE_PATH[1:]), "wb") as package:
+        package.write(PACKAGE)
+    os.makedirs(os.path.join(root, "debian", "dists", "buster"))
+    with open(os.path.join(root, "debian", "dists", "buster", "Release"), "wb") as release:
+        release.write(b"Suite: buster\n")
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=root)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def proxy_get(proxy: AptProxy, url: str, method: str = "GET") -> Tuple[int, bytes]:
+    connection = http.client.HTTPConnection("127.0.0.1", proxy.port)
+    try:
+        connection.request(method, url)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def test_apt_proxy(mirror: http.server.HTTPServer, tmp_path: str) -> None:
+    mirror_url = f"http://127.0.0.1:{mirror.server_address[1]}"
+    with AptProxy(os.path.join(str(tmp_path), "apt"), 1024 * 1024) as proxy:
+        assert proxy_get(proxy, mirror_url + PACKAGE_PATH) == (200, PACKAGE)
+        assert proxy_get(proxy, mirror_url + "/debian/dists/buster/Release") == (
+            200, b"Suite: buster\n"
+        )
+        assert proxy_get(proxy, mirror_url + "/debian/pool/main/b/bar/bar_1.0_all.deb")[0] == 404
+        mirror.shutdown()
+        mirror.server_close()
+        # packages are served from the cache, by their pool paths
+        assert proxy_get(proxy, "http://other.mirror" + PACKAGE_PATH) == (200, PACKAGE)
+        assert proxy_get(proxy, mirror_url + PACKAGE_PATH, "HEAD") == (200, b"")
+        assert proxy_get(proxy, mirror_url + "/debian/dists/buster/Release")[0] == 502
+        assert proxy.cache.stats()["entries"] == 1
+        assert proxy.cache.stats()["hits"] == 2
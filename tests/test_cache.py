@@ -0,0 +1,139 @@
+# pylint: disable=missing-docstring
+import os
+import shutil
+from typing import Callable, IO
+import pytest
+from preseed_install import FileCache, CacheConfig, cached_file_digest, file_digest, parse_size
+from preseed_install import iso_extract_files_cached, ContentStore
+
+
+def write_content(content: bytes) -> Callable[[IO], None]:
+    def write(output: IO) -> None:
+        output.write(content)
+    return write
+
+
+def test_cache_hit_and_miss(tmp_path: str) -> None:
+    cache = FileCache(str(tmp_path), 1024)
+    assert cache.get("foo") is None
+    cache.put("foo", write_content(b"FOO"))
+    path = cache.get("foo")
+    assert path is not None
+    with open(path, "rb") as file:
+        assert file.read() == b"FOO"
+    assert cache.stats() == {"entries": 1, "size": 3, "hits": 1, "misses": 1}
+
+
+def test_cache_eviction(tmp_path: str) -> None:
+    cache = FileCache(str(tmp_path), 10)
+    cache.put("foo", write_content(b"FOO" * 2))
+    os.utime(cache.path("foo"), ns=(0, 0))
+    cache.put("bar", write_content(b"BAR" * 2))
+    assert cache.get("foo") is None
+    assert cache.get("bar") is not None
+
+
+def test_cache_keeps_new_entry_over_budget(tmp_path: str) -> None:
+    cache = FileCache(str(tmp_path), 1)
+    cache.put("foo", write_content(b"FOO"))
+    assert cache.get("foo") is not None
+
+
+def test_extract_cached_over_budget(tmp_path: str) -> None:
+    # each file fits in the budget, but not both
+    cache = CacheConfig(str(tmp_path), 5)
+    iso_filename = shutil.copy("tests/test.iso", str(tmp_path))
+    for _ in range(2):
+        foo, bar = iso_extract_files_cached(iso_filename, ["/foo.txt", "/bar.txt"], cache)
+        with foo, bar:
+            assert (foo.read(), bar.read()) == (b"FOO\n", b"BAR\n")
+            # QEMU opens the files by name
+            for file, content in ((foo, b"FOO\n"), (bar, b"BAR\n")):
+                with open(file.name, "rb") as reopened:
+                    assert reopened.read() == content
+
+
+def test_cache_open_after_eviction(tmp_path: str) -> None:
+    cache = FileCache(str(tmp_path), 1024)
+    cache.put("foo", write_content(b"FOO"))
+    file = cache.open("foo")
+    directory = os.path.dirname(file.name)
+    cache.max_size = 0
+    cache.evict()
+    assert cache.get("foo") is None
+    with open(file.name, "rb") as reopened:
+        assert reopened.read() == b"FOO"
+    assert cache.stats()["entries"] == 0
+    file.close()
+    del file
+    assert not os.path.exists(directory)
+
+
+def test_cached_digest(tmp_path: str) -> None:
+    cache = CacheConfig(str(tmp_path), 1024)
+    iso_filename = shutil.copy("tests/test.iso", str(tmp_path))
+    digest = cached_file_digest(iso_filename, cache)
+    assert digest == cached_file_digest(iso_filename, cache)
+    assert digest == file_digest("tests/test.iso")
+    assert len(digest) == 64
+
+
+def test_cached_digest_changed_file(tmp_path: str) -> None:
+    filename = os.path.join(str(tmp_path), "foo")
+    with open(filename, "wb") as file:
+        file.write(b"FOO")
+    first = cached_file_digest(filename, None)
+    with open(filename, "ab") as file:
+        file.write(b"BAR")
+    assert cached_file_digest(filename, None) != first
+
+
+def test_digest_small_chunks() -> None:
+    assert file_digest("tests/test.iso", chunk_size=1000) == file_digest("tests/test.iso")
+
+
+def test_extract_cached(tmp_path: str) -> None:
+    cache = CacheConfig(str(tmp_path), 1024)
+    iso_filename = shutil.copy("tests/test.iso", str(tmp_path))
+    for _ in range(2):
+        foo, bar = iso_extract_files_cached(iso_filename, ["/foo.txt", "/bar.txt"], cache)
+        with foo, bar:
+            assert (foo.read(), bar.read()) == (b"FOO\n", b"BAR\n")
+    stats = FileCache(os.path.join(str(tmp_path), "boot"), 1024).stats()
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+
+
+def test_content_store(tmp_path: str) -> None:
+    store = ContentStore(os.path.join(str(tmp_path), "store"))
+    targets = []
+    for name in ["a", "b"]:
+        filename = os.path.join(str(tmp_path), name + ".tmp")
+        with open(filename, "wb") as file:
+            file.write(b"KERNEL")
+        targets.append(os.path.join(str(tmp_path), name + ".kernel"))
+        store.link(filename, targets[-1])
+        assert not os.path.exists(filename)
+    assert os.path.samefile(targets[0], targets[1])
+    assert store.stats() == {"entries": 1, "size": 6, "links": 2}
+    os.unlink(targets[0])
+    assert store.gc() == (0, 0)
+    os.unlink(targets[1])
+    assert store.gc() == (1, 6)
+    assert store.stats() == {"entries": 0, "size": 0, "links": 0}
+
+
+@pytest.mark.parametrize(
+    "size,expected",
+    [
+        ("512", 512),
+        ("2K", 2048),
+        ("10G", 10 * 1024 ** 3),
+    ]
+)
+def test_parse_size(size: str, expected: int) -> None:
+    assert parse_size(size) == expected
+
+
+def test_parse_size_exception() -> None:
+    with pytest.raises(ValueError, match="invalid size: 10X"):
+        parse_size("10X")
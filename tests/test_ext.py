@@ -0,0 +1,98 @@
+# pylint: disable=missing-docstring
+import os
+import subprocess
+from typing import Dict
+import pytest
+from preseed_install import ExtFilesystem, RawImage, DebugfsSession, debugfs_command
+
+pytestmark = pytest.mark.skipif(
+    not os.path.exists("/sbin/mkfs.ext2") or not os.path.exists("/sbin/debugfs"),
+    reason="requires e2fsprogs",
+)
+
+LONG_TARGET = "boot/" + "x" * 100 + "/initrd.img-4.19.0-16-amd64"
+
+
+def file_contents(size: int) -> bytes:
+    return bytes(index * 7 % 251 for index in range(size))
+
+
+def make_filesystem(tmp_path: str, fs_type: str, offset: int = 0) -> Dict[str, bytes]:
+    image_filename = os.path.join(tmp_path, "fs.img")
+    with open(image_filename, "wb") as image:
+        image.truncate(offset + 8 * 1024 * 1024)
+    subprocess.run(
+        ["/sbin/mkfs.ext2", "-q", "-t", fs_type, "-b", "1024", "-E", f"offset={offset}",
+         image_filename, "8M"],
+        check=True,
+    )
+    files = {
+        "vmlinuz-4.19.0-16-amd64": file_contents(5000),
+        "initrd.img-4.19.0-16-amd64": file_contents(400 * 1024),
+    }
+    commands = ["mkdir boot", "mkdir boot/" + "x" * 100]
+    for name, content in files.items():
+        host_filename = os.path.join(tmp_path, name)
+        with open(host_filename, "wb") as host_file:
+            host_file.write(content)
+        commands.append(f"write {host_filename} boot/{name}")
+    initrd_host_filename = os.path.join(tmp_path, "initrd.img-4.19.0-16-amd64")
+    commands.append(f"write {initrd_host_filename} {LONG_TARGET}")
+    commands += [
+        "symlink vmlinuz boot/vmlinuz-4.19.0-16-amd64",
+        f"symlink initrd.img {LONG_TARGET}",
+        "symlink boot/current /boot",
+    ]
+    debugfs_command(image_filename, "\n".join(commands), offset)
+    return files
+
+
+@pytest.mark.parametrize("fs_type", ["ext2", "ext3", "ext4"])
+def test_extract(tmp_path: str, fs_type: str) -> None:
+    files = make_filesystem(str(tmp_path), fs_type)
+    kernel_filename = os.path.join(str(tmp_path), "kernel")
+    initrd_filename = os.path.join(str(tmp_path), "initrd")
+    with RawImage(os.path.join(str(tmp_path), "fs.img")) as image:
+        filesystem = ExtFilesystem(image)
+        filesystem.extract("/vmlinuz", kernel_filename)
+        filesystem.extract("/initrd.img", initrd_filename)
+    with open(kernel_filename, "rb") as kernel, open(initrd_filename, "rb") as initrd:
+        assert kernel.read() == files["vmlinuz-4.19.0-16-amd64"]
+        assert initrd.read() == files["initrd.img-4.19.0-16-amd64"]
+
+
+def test_symlinks(tmp_path: str) -> None:
+    make_filesystem(str(tmp_path), "ext4", offset=1024 * 1024)
+    with RawImage(os.path.join(str(tmp_path), "fs.img")) as image:
+        filesystem = ExtFilesystem(image, 1024 * 1024)
+        assert filesystem.readlink(filesystem.lookup("/vmlinuz", False)) == (
+            "boot/vmlinuz-4.19.0-16-amd64"
+        )
+        assert filesystem.readlink(filesystem.lookup("/initrd.img", False)) == LONG_TARGET
+        assert filesystem.lookup("/boot/current/vmlinuz-4.19.0-16-amd64").size == 5000
+
+
+def test_file_not_found(tmp_path: str) -> None:
+    make_filesystem(str(tmp_path), "ext4")
+    with RawImage(os.path.join(str(tmp_path), "fs.img")) as image:
+        with pytest.raises(ValueError, match="file not found: /boot/foo"):
+            ExtFilesystem(image).lookup("/boot/foo")
+
+
+def test_not_ext() -> None:
+    with RawImage("tests/test.iso") as image:
+        with pytest.raises(ValueError, match="not an ext2/3/4 filesystem"):
+            ExtFilesystem(image)
+
+
+def test_debugfs_session(tmp_path: str) -> None:
+    make_filesystem(str(tmp_path), "ext4", offset=1024 * 1024)
+    image_filename = os.path.join(str(tmp_path), "fs.img")
+    with DebugfsSession(image_filename, 1024 * 1024) as session:
+        listing, link = session.run_many(["ls boot", "stat /vmlinuz"])
+        assert "vmlinuz-4.19.0-16-amd64" in listing
+        assert "stat /vmlinuz" not in link
+        assert 'Fast link dest: "boot/vmlinuz-4.19.0-16-amd64"' in link
+        # the filesystem is opened read-only
+        session.run("mkdir foo")
+        assert "foo" not in session.run("ls")
@@ -0,0 +1,253 @@
+# pylint: disable=missing-docstring
+import os
+import select
+import socket
+import struct
+import threading
+import zlib
+from typing import Dict, List, Tuple
+import pytest
+import preseed_install
+from preseed_install import Qcow2Image, RawImage, NbdClient, write_image_range, sparse_copy
+from preseed_install import extract_boot_files
+
+CLUSTER_BITS = 9
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+
+
+def write_qcow2(
+        filename: str,
+        size: int,
+        clusters: Dict[int, bytes],
+        compressed: Dict[int, bytes],
+        zero: Dict[int, bytes],
+    ) -> None:
+    """Write a minimal qcow2 version 3 image with a single L2 table.
+
+    Layout: header, L1 table, L2 table, then one host cluster per guest cluster."""
+    l2_entries = [0] * (CLUSTER_SIZE // 8)
+    data = b""
+    next_offset = 3 * CLUSTER_SIZE
+    for index, content in sorted(clusters.items()):
+        l2_entries[index] = (1 << 63) | next_offset
+        data += content.ljust(CLUSTER_SIZE, b"\0")
+        next_offset += CLUSTER_SIZE
+    for index, content in sorted(compressed.items()):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -12)
+        deflated = compressor.compress(content.ljust(CLUSTER_SIZE, b"\0")) + compressor.flush()
+        offset_bits = 62 - (CLUSTER_BITS - 8)
+        additional_sectors = (len(deflated) + 511) // 512 - 1
+        l2_entries[index] = (1 << 62) | (additional_sectors << offset_bits) | next_offset
+        data += deflated.ljust(CLUSTER_SIZE, b"\0")
+        next_offset += CLUSTER_SIZE
+    for index, content in sorted(zero.items()):
+        # the zero flag takes precedence over the stale cluster contents
+        l2_entries[index] = (1 << 63) | next_offset | 1
+        data += content.ljust(CLUSTER_SIZE, b"\0")
+        next_offset += CLUSTER_SIZE
+    header = struct.pack(
+        ">4sIQIIQIIQQIIQQQQII",
+        b"QFI\xfb", 3, 0, 0, CLUSTER_BITS, size, 0, 1, CLUSTER_SIZE, 0, 0, 0, 0,
+        0, 0, 0, 4, 104,
+    )
+    with open(filename, "wb") as file:
+        file.write(header.ljust(CLUSTER_SIZE, b"\0"))
+        file.write(struct.pack(">Q", (1 << 63) | 2 * CLUSTER_SIZE).ljust(CLUSTER_SIZE, b"\0"))
+        file.write(struct.pack(f">{len(l2_entries)}Q", *l2_entries))
+        file.write(data)
+
+
+@pytest.fixture(name="image_filename")
+def fixture_image_filename(tmp_path: str) -> str:
+    filename = os.path.join(str(tmp_path), "test.qcow2")
+    write_qcow2(
+        filename,
+        16 * CLUSTER_SIZE,
+        clusters={1: b"FOO", 2: b"BAR"},
+        compressed={5: b"BAZ" * 100},
+        zero={7: b"STALE"},
+    )
+    return filename
+
+
+def test_read(image_filename: str) -> None:
+    with Qcow2Image(image_filename) as image:
+        assert image.size == 16 * CLUSTER_SIZE
+        assert image.read(0, CLUSTER_SIZE) == bytes(CLUSTER_SIZE)
+        assert image.read(CLUSTER_SIZE, 3) == b"FOO"
+        assert image.read(2 * CLUSTER_SIZE - 1, 4) == b"\0BAR"
+        assert image.read(5 * CLUSTER_SIZE, 300) == b"BAZ" * 100
+        assert image.read(7 * CLUSTER_SIZE, 5) == bytes(5)
+        assert image.read(16 * CLUSTER_SIZE - 2, 10) == bytes(2)
+
+
+def test_allocated_ranges(image_filename: str) -> None:
+    with Qcow2Image(image_filename) as image:
+        assert list(image.allocated_ranges(0, image.size)) == [
+            (CLUSTER_SIZE, 3 * CLUSTER_SIZE),
+            (5 * CLUSTER_SIZE, 6 * CLUSTER_SIZE),
+        ]
+        assert list(image.allocated_ranges(CLUSTER_SIZE + 10, 2 * CLUSTER_SIZE)) == [
+            (CLUSTER_SIZE + 10, 2 * CLUSTER_SIZE),
+        ]
+
+
+def test_write_image_range(image_filename: str, tmp_path: str) -> None:
+    output_filename = os.path.join(str(tmp_path), "range")
+    with Qcow2Image(image_filename) as image:
+        write_image_range(image, output_filename, 2 * CLUSTER_SIZE, 4 * CLUSTER_SIZE)
+        expected = image.read(2 * CLUSTER_SIZE, 4 * CLUSTER_SIZE)
+    with open(output_filename, "rb") as output:
+        assert output.read() == expected
+
+
+def test_not_qcow2() -> None:
+    with pytest.raises(ValueError, match="not a qcow2 image: tests/test.iso"):
+        Qcow2Image("tests/test.iso")
+
+
+def test_raw_allocated_ranges(tmp_path: str) -> None:
+    filename = os.path.join(str(tmp_path), "test.raw")
+    with open(filename, "wb") as file:
+        file.truncate(1024 * 1024)
+        file.seek(256 * 1024)
+        file.write(b"FOO" * 1024)
+    with RawImage(filename) as image:
+        assert image.size == 1024 * 1024
+        ranges = list(image.allocated_ranges(0, image.size))
+        assert ranges
+        assert all(start <= 256 * 1024 and end >= 256 * 1024 + 3072 for start, end in ranges)
+        assert image.read(256 * 1024, 6) == b"FOOFOO"
+
+
+def test_raw_allocated_ranges_empty(tmp_path: str) -> None:
+    filename = os.path.join(str(tmp_path), "test.raw")
+    with open(filename, "wb") as file:
+        file.truncate(1024 * 1024)
+    with RawImage(filename) as image:
+        assert list(image.allocated_ranges(0, image.size)) in ([], [(0, image.size)])
+
+
+def test_sparse_copy(tmp_path: str) -> None:
+    source_filename = os.path.join(str(tmp_path), "source")
+    with open(source_filename, "wb") as source:
+        source.truncate(4 * 1024 * 1024)
+        source.seek(1024 * 1024)
+        source.write(b"FOO" * 1024)
+    target_filename = os.path.join(str(tmp_path), "target")
+    with open(source_filename, "rb") as source, open(target_filename, "wb") as target:
+        stats = sparse_copy(source.fileno(), target.fileno(), 4096, 3 * 1024 * 1024, 512)
+    assert stats.copied + stats.skipped == 3 * 1024 * 1024
+    assert stats.copied >= 3072
+    with open(source_filename, "rb") as source, open(target_filename, "rb") as target:
+        source.seek(4096)
+        assert target.read() == bytes(512) + source.read(3 * 1024 * 1024)
+
+
+def test_raw_write_image_range(tmp_path: str) -> None:
+    filename = os.path.join(str(tmp_path), "test.raw")
+    with open(filename, "wb") as file:
+        file.truncate(1024 * 1024)
+        file.seek(1024 * 1024 - 3)
+        file.write(b"BAR")
+    output_filename = os.path.join(str(tmp_path), "range")
+    with RawImage(filename) as image:
+        stats = write_image_range(image, output_filename, 512 * 1024, 1024 * 1024)
+    assert stats.copied + stats.skipped == 512 * 1024
+    with open(output_filename, "rb") as output:
+        assert output.read() == bytes(512 * 1024 - 3) + b"BAR" + bytes(512 * 1024)
+
+
+def test_extract_boot_files_closes_image(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    filename = os.path.join(str(tmp_path), "test.raw")
+    with open(filename, "wb") as file:
+        file.truncate(1024 * 1024)
+    closed = []
+
+    class TrackedImage(RawImage):
+        def close(self) -> None:
+            closed.append(True)
+            super().close()
+
+    monkeypatch.setattr(preseed_install, "open_disk_image", TrackedImage)
+    with pytest.raises(ValueError, match="no partition table found"):
+        extract_boot_files(filename)
+    assert closed
+
+
+def receive_exactly(sock: socket.socket, length: int) -> bytes:
+    data = b""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def serve_nbd(sock: socket.socket, export: bytes, structured: bool) -> None:
+    """A fake NBD server which replies to each batch of requests in reverse order.
+
+    Structured replies send the data and the trailing zeros of each read as
+    separate data and hole chunks."""
+    # pylint: disable=too-many-locals
+    sock.sendall(b"NBDMAGIC" + struct.pack(">QH", 0x49484156454F5054, 3))
+    receive_exactly(sock, 4)
+    while True:
+        _, option, length = struct.unpack(">QII", receive_exactly(sock, 16))
+        receive_exactly(sock, length)
+        reply_type = 1
+        if option == 8 and not structured:
+            reply_type = (1 << 31) | 1
+        if option == 7:
+            info = struct.pack(">HQH", 0, len(export), 1)
+            sock.sendall(struct.pack(">QIII", 0x3E889045565A9, option, 3, len(info)) + info)
+        sock.sendall(struct.pack(">QIII", 0x3E889045565A9, option, reply_type, 0))
+        if option == 7:
+            break
+    requests: List[Tuple[int, int, int]] = []
+    while True:
+        readable, _, _ = select.select([sock], [], [], 0.1 if requests else None)
+        if readable:
+            header = receive_exactly(sock, 28)
+            _, _, command, handle, offset, length = struct.unpack(">IHHQQI", header)
+            if command == 2:
+                sock.close()
+                return
+            requests.append((handle, offset, length))
+            continue
+        for handle, offset, length in reversed(requests):
+            data = export[offset:offset + length]
+            if not structured:
+                sock.sendall(struct.pack(">IIQ", 0x67446698, 0, handle) + data)
+                continue
+            content = data.rstrip(b"\0")
+            if content:
+                sock.sendall(
+                    struct.pack(">IHHQIQ", 0x668E33EF, 0, 1, handle, 8 + len(content), offset)
+                    + content
+                )
+            hole = length - len(content)
+            if hole:
+                sock.sendall(struct.pack(
+                    ">IHHQIQI", 0x668E33EF, 0, 2, handle, 12, offset + len(content), hole,
+                ))
+            sock.sendall(struct.pack(">IHHQI", 0x668E33EF, 1, 0, handle, 0))
+        requests = []
+
+
+@pytest.mark.parametrize("structured", [True, False])
+def test_nbd_client(structured: bool) -> None:
+    export = b"".join(bytes([index]) * 1000 + bytes(24) for index in range(1, 101))
+    client_socket, server_socket = socket.socketpair()
+    server = threading.Thread(target=serve_nbd, args=(server_socket, export, structured))
+    server.start()
+    client = NbdClient(client_socket, request_size=1024, max_in_flight=8)
+    try:
+        assert client.structured_replies == structured
+        assert client.size == len(export)
+        assert client.read(0, len(export)) == export
+        assert client.read(1000, 30) == bytes(24) + b"\2" * 6
+        assert client.read(len(export) - 10, 100) == bytes(10)
+    finally:
+        client.close()
+        server.join()
@@ -0,0 +1,57 @@
+# pylint: disable=missing-docstring
+import gzip
+import os
+import tempfile
+from typing import IO
+from preseed_install import cpio_archive, initrd_add_preseed, initrd_add_preseed_cached
+from preseed_install import CacheConfig, FileCache
+
+
+def test_cpio_archive() -> None:
+    archive = cpio_archive([("preseed.cfg", b"d-i foo/bar string baz\n")])
+    assert len(archive) % 4 == 0
+    assert archive.startswith(b"070701")
+    header_fields = [int(archive[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+    assert header_fields[1] == 0o100644
+    assert header_fields[6] == len(b"d-i foo/bar string baz\n")
+    assert header_fields[11] == len(b"preseed.cfg\0")
+    assert archive[110:122] == b"preseed.cfg\0"
+    assert b"d-i foo/bar string baz\n" in archive
+    assert b"TRAILER!!!\0" in archive
+
+
+def test_initrd_add_preseed() -> None:
+    original = gzip.compress(cpio_archive([("init", b"#!/bin/sh\n")]))
+    with tempfile.NamedTemporaryFile() as initrd, tempfile.NamedTemporaryFile() as preseed:
+        initrd.write(original)
+        initrd.flush()
+        preseed.write(b"d-i foo/bar string baz\n")
+        preseed.flush()
+        with initrd_add_preseed(initrd, preseed.name) as output:
+            output.seek(0)
+            combined = output.read()
+    assert combined.startswith(original)
+    unpacked = gzip.decompress(combined)
+    assert unpacked.startswith(cpio_archive([("init", b"#!/bin/sh\n")]))
+    assert unpacked.endswith(cpio_archive([("preseed.cfg", b"d-i foo/bar string baz\n")]))
+
+
+def write_initrd(output: IO) -> None:
+    output.write(b"INITRD")
+
+
+def test_initrd_add_preseed_cached(tmp_path: str) -> None:
+    cache = CacheConfig(str(tmp_path), 1024 * 1024)
+    initrd_cache = FileCache(os.path.join(str(tmp_path), "boot"), cache.max_size)
+    initrd_filename = initrd_cache.put("initrd", write_initrd)
+    with tempfile.NamedTemporaryFile() as preseed, open(initrd_filename, "rb") as initrd:
+        preseed.write(b"d-i foo/bar string baz\n")
+        preseed.flush()
+        with initrd_add_preseed_cached(initrd, preseed.name, cache) as first:
+            combined = first.read()
+        with initrd_add_preseed_cached(initrd, preseed.name, cache) as second:
+            assert os.path.basename(second.name) == os.path.basename(first.name)
+            assert second.read() == combined
+    assert combined.startswith(b"INITRD")
+    stats = FileCache(os.path.join(str(tmp_path), "initrd"), cache.max_size).stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
@@ -1,7 +1,13 @@
 # pylint: disable=missing-docstring
+import os
+import shutil
+from typing import Tuple, Optional, List
 import pytest
 from preseed_install import get_debian_version, get_debian_architecture, iso_is_arm
-from preseed_install import iso_get_boot_filenames, iso_extract_file
+from preseed_install import discover_boot_files, BootFiles, iso_extract_files_tmp
+from preseed_install import iso_list_installer_files
+from preseed_install import IsoImage, IsoInfo, parse_disk_info, parse_volume_id
+from preseed_install import verify_iso, parse_sha256sums, file_digest
 
 
 def test_version() -> None:
@@ -28,44 +34,105 @@ def test_architecture_exception() -> None:
         get_debian_architecture("ubuntu-22.10-desktop-amd64.iso")
 
 
+@pytest.mark.parametrize(
+    "disk_info,expected",
+    [
+        ('Debian GNU/Linux 9.13.0 "Stretch" - Official i386 NETINST 20200718-11:06', (9, "i386")),
+        ('Debian GNU/Linux 10.1.0 "Buster" - Official armhf NETINST 20190908-02:17', (10, "armhf")),
+        (
+            'Debian GNU/Linux 12.5.0 "Bookworm" - Official amd64 NETINST with firmware 20240210-11:28',
+            (12, "amd64"),
+        ),
+        ('Debian GNU/Linux testing "Trixie" - Official Snapshot amd64 NETINST', (None, None)),
+    ]
+)
+def test_disk_info(disk_info: str, expected: Tuple[Optional[int], Optional[str]]) -> None:
+    assert parse_disk_info(disk_info) == expected
+
+
+@pytest.mark.parametrize(
+    "volume_id,expected",
+    [
+        ("Debian 10.1.0 armhf n", (10, "armhf")),
+        ("Debian 11.5.0 amd64 1", (11, "amd64")),
+        ("CDROM", (None, None)),
+    ]
+)
+def test_volume_id(volume_id: str, expected: Tuple[Optional[int], Optional[str]]) -> None:
+    assert parse_volume_id(volume_id) == expected
+
+
+def test_info_falls_back_to_filename() -> None:
+    with pytest.raises(ValueError, match="can't read Debian version: test.iso"):
+        IsoInfo("tests/test.iso").version
+
+
 def test_is_arm() -> None:
-    assert iso_is_arm("debian-10.1.0-armhf-netinst.iso")
+    assert iso_is_arm(IsoInfo("debian-10.1.0-armhf-netinst.iso"))
 
 
 def test_is_not_arm() -> None:
-    assert not iso_is_arm("debian-10.10.0-amd64-netinst.iso")
+    assert not iso_is_arm(IsoInfo("debian-10.10.0-amd64-netinst.iso"))
+
+
+def installer_files(*directories: str) -> List[str]:
+    return [
+        f"{directory}/{name}"
+        for directory in directories
+        for name in ("vmlinuz", "initrd.gz")
+    ]
 
 
 @pytest.mark.parametrize(
-    "iso_filename",
+    "paths,architecture,expected",
     [
-        "debian-9.13.0-i386-netinst.iso",
-        "debian-9.13.0-amd64-netinst.iso",
-        "debian-9.13.0-arm64-netinst.iso",
-        "debian-9.13.0-armhf-netinst.iso",
-        "debian-10.13.0-i386-netinst.iso",
-        "debian-10.13.0-arm64-netinst.iso",
-        "debian-10.10.0-amd64-netinst.iso",
-        "debian-10.1.0-armhf-netinst.iso",
-        "debian-11.5.0-amd64-netinst.iso",
+        (
+            installer_files("/install.386", "/install.386/gtk", "/install.386/xen"),
+            "i386",
+            BootFiles("/install.386/vmlinuz", "/install.386/initrd.gz", "cdrom"),
+        ),
+        (
+            installer_files("/install.amd", "/install.386"),
+            "amd64",
+            BootFiles("/install.amd/vmlinuz", "/install.amd/initrd.gz", "cdrom"),
+        ),
+        (
+            installer_files("/install.ahf/cdrom", "/install.ahf/netboot"),
+            "armhf",
+            BootFiles("/install.ahf/cdrom/vmlinuz", "/install.ahf/cdrom/initrd.gz", "cdrom"),
+        ),
+        (
+            installer_files("/install/hd-media", "/install/netboot"),
+            "armhf",
+            BootFiles("/install/hd-media/vmlinuz", "/install/hd-media/initrd.gz", "hd-media"),
+        ),
     ]
 )
-def test_boot_filenames(iso_filename: str) -> None:
-    kernel, initrd = iso_get_boot_filenames(iso_filename)
-    assert isinstance(kernel, str)
-    assert isinstance(initrd, str)
+def test_boot_files(paths: List[str], architecture: str, expected: BootFiles) -> None:
+    assert discover_boot_files(paths, architecture) == expected
 
 
-def test_boot_filenames_unknown_image() -> None:
+def test_boot_files_not_found() -> None:
     with pytest.raises(
         ValueError,
-        match="unsupported Debian version or architecture: 11, i386"
+        match="no installer kernel and initrd found for architecture: i386"
     ):
-        iso_get_boot_filenames("debian-11.5.0-i386-netinst.iso")
+        discover_boot_files(installer_files("/install.amd", "/install.a64"), "i386")
+
+
+def test_boot_files_without_initrd() -> None:
+    with pytest.raises(ValueError):
+        discover_boot_files(["/install.amd/vmlinuz"], "amd64")
+
+
+def test_list_installer_files() -> None:
+    assert not iso_list_installer_files("tests/test.iso")
 
 
 def test_extract() -> None:
-    assert iso_extract_file("tests/test.iso", "/foo.txt") == b"FOO\n"
+    tmp_foo, = iso_extract_files_tmp("tests/test.iso", ["/foo.txt"])
+    with tmp_foo, open(tmp_foo.name, "rb") as foo:
+        assert foo.read() == b"FOO\n"
 
 
 def test_extract_exception() -> None:
@@ -73,4 +140,59 @@ def test_extract_exception() -> None:
         ValueError,
         match="failed to extract file: /baz.txt from ISO: tests/test.iso"
     ):
-        iso_extract_file("tests/test.iso", "/baz.txt")
+        iso_extract_files_tmp("tests/test.iso", ["/foo.txt", "/baz.txt"])
+
+
+def test_extract_multiple() -> None:
+    tmp_foo, tmp_bar = iso_extract_files_tmp("tests/test.iso", ["/foo.txt", "/bar.txt"])
+    with tmp_foo, tmp_bar, open(tmp_foo.name, "rb") as foo, open(tmp_bar.name, "rb") as bar:
+        assert (foo.read(), bar.read()) == (b"FOO\n", b"BAR\n")
+
+
+def test_walk() -> None:
+    with IsoImage("tests/test.iso") as iso:
+        assert sorted(iso_file.path for iso_file in iso.walk()) == ["/bar.txt", "/foo.txt"]
+
+
+def test_not_an_iso() -> None:
+    with pytest.raises(ValueError, match="not an ISO 9660 image: tests/test_iso.py"):
+        IsoImage("tests/test_iso.py")
+
+
+def test_sha256sums() -> None:
+    assert parse_sha256sums(f"{'a' * 64}  foo.iso\n\n{'B' * 64} *bar.iso\n\n") == {
+        "foo.iso": "a" * 64,
+        "bar.iso": "b" * 64,
+    }
+
+
+def test_sha256sums_exception() -> None:
+    with pytest.raises(ValueError, match="unable to parse SHA256SUMS line: foo"):
+        parse_sha256sums("foo")
+
+
+@pytest.mark.parametrize("listed_name", ["test.iso", "debian-12.0.0-amd64-netinst.iso"])
+def test_verify(tmp_path: str, listed_name: str) -> None:
+    iso_filename = shutil.copy("tests/test.iso", str(tmp_path))
+    sums_filename = os.path.join(str(tmp_path), "SHA256SUMS")
+    with open(sums_filename, "w", encoding="ascii") as sums:
+        sums.write(f"{file_digest(iso_filename)}  {listed_name}\n")
+    verify_iso(iso_filename, sums_filename, None)
+
+
+def test_verify_mismatch(tmp_path: str) -> None:
+    iso_filename = shutil.copy("tests/test.iso", str(tmp_path))
+    sums_filename = os.path.join(str(tmp_path), "SHA256SUMS")
+    with open(sums_filename, "w", encoding="ascii") as sums:
+        sums.write(f"{'0' * 64}  test.iso\n")
+    with pytest.raises(ValueError, match="SHA-256 digest mismatch"):
+        verify_iso(iso_filename, sums_filename, None)
+
+
+def test_verify_not_listed(tmp_path: str) -> None:
+    iso_filename = shutil.copy("tests/test.iso", str(tmp_path))
+    sums_filename = os.path.join(str(tmp_path), "SHA256SUMS")
+    with open(sums_filename, "w", encoding="ascii") as sums:
+        sums.write(f"{'0' * 64}  other.iso\n")
+    with pytest.raises(ValueError, match="not listed in"):
+        verify_iso(iso_filename, sums_filename, None)
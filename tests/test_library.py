@@ -0,0 +1,40 @@
+# pylint: disable=missing-docstring
+import os
+import shutil
+from preseed_install import CacheConfig, LibraryEntry, library_index, library_find, locked_json
+
+
+def test_index_skips_unknown_images(tmp_path: str) -> None:
+    iso_directory = os.path.join(str(tmp_path), "iso")
+    os.mkdir(iso_directory)
+    shutil.copy("tests/test.iso", iso_directory)
+    # a vanished image
+    os.symlink("missing.iso", os.path.join(iso_directory, "dangling.iso"))
+    cache = CacheConfig(os.path.join(str(tmp_path), "cache"), 1024)
+    assert not library_index([iso_directory], cache)
+    assert not library_find(cache)
+
+
+def test_find(tmp_path: str) -> None:
+    cache = CacheConfig(str(tmp_path), 1024)
+    entries = [
+        LibraryEntry(
+            f"/iso/debian-{version}-{architecture}.iso",
+            version,
+            architecture,
+            "/install.xxx/vmlinuz",
+            "/install.xxx/initrd.gz",
+            "cdrom",
+            "0" * 64,
+            1024,
+        )
+        for version in (10, 11)
+        for architecture in ("amd64", "arm64")
+    ]
+    with locked_json(os.path.join(str(tmp_path), "library.json")) as index:
+        for entry in entries:
+            index[entry.filename] = {"fingerprint": "", "entry": entry._asdict()}
+    assert library_find(cache, 11, "arm64") == [entries[3]]
+    assert library_find(cache, version=10) == entries[:2]
+    assert library_find(cache, architecture="amd64") == [entries[0], entries[2]]
+    assert library_find(cache) == entries
@@ -1,33 +1,120 @@
 # pylint: disable=missing-docstring
 import os.path
+import json
+import shutil
+import struct
+import subprocess
+import uuid
+import zlib
+from typing import Dict
 import pytest
-from preseed_install import parse_fdisk_units, parse_fdisk_sector_size, parse_symlink_target
-
-
-def test_fdisk_units() -> None:
-    assert parse_fdisk_units(load_test_data("valid_fdisk_output.txt")) == 512
-
-
-def test_fdisk_units_exception() -> None:
-    with pytest.raises(ValueError):
-        parse_fdisk_units("")
-
-
-def test_fdisk_sector_size() -> None:
-    assert parse_fdisk_sector_size(load_test_data("valid_fdisk_output.txt")) == 512
-
-
-def test_fdisk_sector_size_exception() -> None:
-    with pytest.raises(ValueError):
-        parse_fdisk_sector_size("")
-
-
-def test_fdisk_sector_size_mismatch_exception() -> None:
-    with pytest.raises(
-        ValueError,
-        match="partition table logical and physical sector sizes differ: 512 != 1024"
-    ):
-        parse_fdisk_sector_size(load_test_data("invalid_sector_size_fdisk_output.txt"))
+from preseed_install import parse_symlink_target, list_partitions, find_boot_partition
+from preseed_install import Partition, RawImage
+from preseed_install import mbr_partition_table, create_installer_hd, debugfs_command
+from preseed_install import FileCache, CacheConfig, create_installer_hd_overlay
+from preseed_install import create_installer_hd_directory, link_or_reflink
+
+
+def mbr_entry(
+        partition_type: int,
+        start_sector: int,
+        size_in_sectors: int,
+        status: int = 0,
+    ) -> bytes:
+    chs = b"\xfe\xff\xff"
+    return struct.pack(
+        "<B3sB3sII", status, chs, partition_type, chs, start_sector, size_in_sectors
+    )
+
+
+def boot_record(*entries: bytes) -> bytes:
+    return bytes(446) + b"".join(entries).ljust(64, b"\0") + b"\x55\xaa"
+
+
+def write_image(filename: str, sectors: Dict[int, bytes]) -> None:
+    with open(filename, "wb") as file:
+        file.truncate(4096 * 512)
+        for sector, data in sectors.items():
+            file.seek(sector * 512)
+            file.write(data)
+
+
+def test_mbr_partitions(tmp_path: str) -> None:
+    filename = os.path.join(str(tmp_path), "mbr.raw")
+    write_image(filename, {
+        0: boot_record(
+            mbr_entry(0x83, 2048, 1000, 0x80),
+            mbr_entry(0x05, 3072, 1024),
+        ),
+        # first EBR: a logical partition and a link to the next EBR
+        3072: boot_record(mbr_entry(0x82, 1, 100), mbr_entry(0x05, 200, 300)),
+        3272: boot_record(mbr_entry(0x83, 2, 50)),
+    })
+    with RawImage(filename) as image:
+        assert list(list_partitions(image)) == [
+            Partition("Linux", 512, 2048, 1000, True),
+            Partition("Extended", 512, 3072, 1024, False),
+            Partition("Linux swap / Solaris", 512, 3073, 100, False),
+            Partition("Linux", 512, 3274, 50, False),
+        ]
+        assert find_boot_partition(list_partitions(image)).start_sector == 2048
+
+
+def test_gpt_partitions(tmp_path: str) -> None:
+    linux_guid = uuid.UUID("0FC63DAF-8483-4772-8E79-3D69D8477DE4").bytes_le
+    esp_guid = uuid.UUID("C12A7328-F81F-11D2-BA4B-00A0C93EC93B").bytes_le
+    entries = b"".join([
+        (esp_guid + bytes(16) + struct.pack("<QQQ", 2048, 4095, 0)).ljust(128, b"\0"),
+        (linux_guid + bytes(16) + struct.pack("<QQQ", 4096, 8191, 1 << 2)).ljust(128, b"\0"),
+    ]).ljust(128 * 128, b"\0")
+    header = bytearray(struct.pack(
+        "<8sIII4xQQQQ16sQIII",
+        b"EFI PART", 0x10000, 92, 0, 1, 8191, 34, 8158, bytes(16), 2, 128, 128,
+        zlib.crc32(entries),
+    ))
+    struct.pack_into("<I", header, 16, zlib.crc32(bytes(header)))
+    filename = os.path.join(str(tmp_path), "gpt.raw")
+    write_image(filename, {0: boot_record(mbr_entry(0xee, 1, 8191)), 1: bytes(header), 2: entries})
+    with RawImage(filename) as image:
+        assert list(list_partitions(image)) == [
+            Partition("EFI System", 512, 2048, 2048, False),
+            Partition("Linux filesystem", 512, 4096, 4096, True),
+        ]
+
+
+def test_gpt_checksum_exception(tmp_path: str) -> None:
+    header = struct.pack("<8sIII", b"EFI PART", 0x10000, 92, 12345).ljust(92, b"\0")
+    filename = os.path.join(str(tmp_path), "gpt.raw")
+    write_image(filename, {0: boot_record(mbr_entry(0xee, 1, 8191)), 1: header})
+    with RawImage(filename) as image:
+        with pytest.raises(ValueError, match="GPT header checksum mismatch"):
+            list(list_partitions(image))
+
+
+def test_no_partition_table(tmp_path: str) -> None:
+    filename = os.path.join(str(tmp_path), "empty.raw")
+    write_image(filename, {})
+    with RawImage(filename) as image:
+        with pytest.raises(ValueError, match="no partition table found"):
+            list(list_partitions(image))
+
+
+def test_no_boot_partition() -> None:
+    with pytest.raises(ValueError, match="no Linux partition found"):
+        find_boot_partition([Partition("EFI System", 512, 2048, 1000, False)])
+
+
+def test_find_boot_partition_without_bootable_attribute() -> None:
+    partitions = [
+        Partition("EFI System", 512, 2048, 1000, False),
+        Partition("Linux filesystem", 512, 4096, 1000, False),
+        Partition("Linux filesystem", 512, 8192, 1000, False),
+    ]
+    assert find_boot_partition(partitions).start_sector == 4096
+    assert find_boot_partition(
+        partitions, lambda partition: partition.start_sector == 8192
+    ).start_sector == 8192
+    assert find_boot_partition(partitions, lambda _: False).start_sector == 4096
 
 
 def test_symlink_target() -> None:
@@ -40,6 +127,83 @@ def test_symlink_target_exception() -> None:
         parse_symlink_target("")
 
 
+def test_mbr_partition_table() -> None:
+    mbr = mbr_partition_table(2048, 4096)
+    assert len(mbr) == 512
+    assert mbr == boot_record(mbr_entry(0x83, 2048, 4096))
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/sbin/mkfs.ext2") or not os.path.exists("/sbin/debugfs"),
+    reason="requires e2fsprogs",
+)
+def test_create_installer_hd() -> None:
+    with create_installer_hd("tests/test.iso") as disk_image:
+        disk_image.seek(0)
+        start_sector, size_in_sectors = struct.unpack_from("<II", disk_image.read(512), 454)
+        assert start_sector == 2048
+        assert (start_sector + size_in_sectors) * 512 == os.fstat(disk_image.fileno()).st_size
+        listing = debugfs_command(disk_image.name, "ls -l", start_sector * 512)
+        assert "test.iso" in listing
+        assert str(os.stat("tests/test.iso").st_size) in listing
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/sbin/mkfs.ext2") or not os.path.exists("/sbin/debugfs")
+    or not shutil.which("qemu-img"),
+    reason="requires e2fsprogs and qemu-img",
+)
+def test_create_installer_hd_overlay(tmp_path: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    iso_filename = os.path.abspath("tests/test.iso")
+    monkeypatch.chdir(str(tmp_path))
+    cache = CacheConfig("cache", 1024 ** 3)
+    for _ in range(2):
+        with create_installer_hd_overlay(iso_filename, cache) as overlay:
+            info = json.loads(subprocess.run(
+                ["qemu-img", "info", "--output=json", overlay.name],
+                check=True, stdout=subprocess.PIPE,
+            ).stdout)
+            assert info["format"] == "qcow2"
+            assert os.path.isabs(info["backing-filename"])
+            assert os.path.getsize(info["backing-filename"]) == info["virtual-size"]
+    stats = FileCache(os.path.join("cache", "installer-hd"), cache.max_size).stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_create_installer_hd_directory() -> None:
+    with create_installer_hd_directory("tests/test.iso") as directory:
+        staged = os.path.join(directory, "test.iso")
+        assert os.path.getsize(staged) == os.path.getsize("tests/test.iso")
+    assert not os.path.exists(directory)
+
+
 def load_test_data(name: str) -> str:
     with open(os.path.join("tests", name), "r", encoding="ascii") as file:
         return file.read()
+
+
+def test_link_or_reflink_keeps_existing_target(tmp_path: str) -> None:
+    target = os.path.join(str(tmp_path), "target")
+    with open(target, "wb") as target_file:
+        target_file.write(b"TARGET")
+    with pytest.raises((OSError, ValueError)):
+        link_or_reflink("tests/test.iso", target)
+    with open(target, "rb") as target_file:
+        assert target_file.read() == b"TARGET"
+
+
+def test_create_installer_hd_directory_colon(tmp_path: str) -> None:
+    iso_dir = os.path.join(str(tmp_path), "iso:dir")
+    os.mkdir(iso_dir)
+    iso_filename = shutil.copy("tests/test.iso", iso_dir)
+    with create_installer_hd_directory(iso_filename) as directory:
+        assert ":" not in directory
+        assert os.path.exists(os.path.join(directory, "test.iso"))
+
+
+def test_create_installer_hd_directory_too_large(tmp_path: str) -> None:
+    iso_filename = os.path.join(str(tmp_path), "large.iso")
+    with open(iso_filename, "wb") as iso_file:
+        iso_file.truncate(600 * 1024 * 1024)
+    with pytest.raises(ValueError, match="too large for a virtual FAT disk"):
+        create_installer_hd_directory(iso_filename)
@@ -0,0 +1,54 @@
+# pylint: disable=missing-docstring
+import pytest
+import preseed_install
+from preseed_install import guest_resources, parse_auto, parse_size, select_accelerator
+
+
+@pytest.fixture(name="host")
+def fixture_host(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(preseed_install.os, "cpu_count", lambda: 16)
+    monkeypatch.setattr(preseed_install, "available_memory", lambda: 12 * 1024 ** 3)
+
+
+@pytest.mark.usefixtures("host")
+@pytest.mark.parametrize("arch, running_installs, expected", [
+    ("amd64", 0, (8, 4 * 1024 ** 3)),
+    ("amd64", 1, (8, 3 * 1024 ** 3)),
+    ("amd64", 3, (4, 1536 * 1024 ** 2)),
+    ("amd64", 100, (1, 1024 ** 3)),
+    ("i386", 0, (8, 3 * 1024 ** 3)),
+])
+def test_guest_resources_auto(arch: str, running_installs: int, expected: tuple) -> None:
+    assert guest_resources("auto", "auto", arch, running_installs) == expected
+
+
+@pytest.mark.usefixtures("host")
+def test_guest_resources_given() -> None:
+    assert guest_resources(2, 512 * 1024 ** 2, "amd64", 0) == (2, 512 * 1024 ** 2)
+
+
+def test_parse_auto() -> None:
+    assert parse_auto(parse_size)("auto") == "auto"
+    assert parse_auto(parse_size)("2G") == 2 * 1024 ** 3
+    with pytest.raises(ValueError):
+        parse_auto(int)("0")
+
+
+@pytest.mark.parametrize("machine, kvm_access, arch, expected", [
+    ("x86_64", True, "amd64", "kvm"),
+    ("x86_64", True, "i386", "kvm"),
+    ("x86_64", False, "amd64", "tcg,thread=multi"),
+    ("x86_64", True, "arm64", "tcg,thread=multi"),
+    ("aarch64", True, "arm64", "kvm"),
+    ("aarch64", True, "armhf", "tcg,thread=multi"),
+])
+def test_select_accelerator(
+        monkeypatch: pytest.MonkeyPatch,
+        machine: str,
+        kvm_access: bool,
+        arch: str,
+        expected: str,
+    ) -> None:
+    monkeypatch.setattr(preseed_install.platform, "machine", lambda: machine)
+    monkeypatch.setattr(preseed_install.os, "access", lambda path, mode: kvm_access)
+    assert select_accelerator(arch) == expected